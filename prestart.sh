@@ -0,0 +1,9 @@
+#! /usr/bin/env sh
+# Run by the image before uWSGI starts its workers: builds missing database
+# indexes once per deployment instead of in every worker. The workers do not
+# build indexes themselves, so the container must not start without them.
+cd /app
+if ! python indexes.py; then
+    echo "Syncing the database indexes failed, not starting" >&2
+    exit 1
+fi
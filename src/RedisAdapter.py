@@ -1,58 +1,384 @@
+import os
+import threading
 import redis
-import pickle
 import config
+import metrics
+from codec import PickleCodec
+
+# Connection state shared by all adapters of the current process
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+_registered_databases = set()
+
+
+def parse_address(address):
+    redis_address = address.split(":")
+    redis_host = redis_address[0]
+    if len(redis_address) > 1:
+        redis_port = int(redis_address[1])
+    else:
+        redis_port = 6379
+    return redis_host, redis_port
+
+
+def key_prefixes(database):
+    """Returns the management and value key prefixes of a namespace"""
+    database = "bluquist_" + config.ENVIRONMENT + "_" + str(database)
+    return database + "_m_", database + "_v_"
+
+
+def get_client():
+    """Returns the redis client shared by all adapters of this process
+
+    The client and its connection pool are created lazily and recreated after
+    a fork, so uWSGI workers never share sockets with the master process.
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                redis_host, redis_port = parse_address(config.REDIS)
+                pool = redis.BlockingConnectionPool(
+                    host=redis_host,
+                    port=redis_port,
+                    db=0,
+                    max_connections=config.REDIS_MAX_CONNECTIONS,
+                    timeout=config.REDIS_POOL_TIMEOUT,
+                    socket_timeout=config.REDIS_SOCKET_TIMEOUT,
+                    socket_connect_timeout=config.REDIS_CONNECT_TIMEOUT,
+                )
+                _client = redis.StrictRedis(connection_pool=pool)
+                _client_pid = pid
+    return _client
+
+
+# Updates fields of a hash value without recreating it once it is gone.
+# Values still stored as strings only get their expiration date updated.
+UPDATE_FIELDS_SCRIPT = """
+local value_type = redis.call("TYPE", KEYS[1]).ok
+if value_type == "none" then
+    return 0
+end
+if value_type == "hash" then
+    for i = 2, #ARGV, 2 do
+        redis.call("HSET", KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+if ARGV[1] ~= "" then
+    redis.call("EXPIREAT", KEYS[1], ARGV[1])
+end
+return 1
+"""
+_update_fields = None
+
+# Sliding window log of requests, one sorted set of timestamps per window.
+# A request is only recorded if every window has room for it, otherwise the
+# milliseconds until each window has room again are returned (0 for windows
+# with room). ARGV: current time in ms, unique member, then limit and length
+# in ms of each window in KEYS.
+SLIDING_WINDOW_SCRIPT = """
+local now = tonumber(ARGV[1])
+local waits = {}
+local full = false
+for i, key in ipairs(KEYS) do
+    local limit = tonumber(ARGV[1 + 2 * i])
+    local length = tonumber(ARGV[2 + 2 * i])
+    redis.call("ZREMRANGEBYSCORE", key, "-inf", now - length)
+    local count = redis.call("ZCARD", key)
+    waits[i] = 0
+    if count >= limit then
+        local oldest = redis.call("ZRANGE", key, count - limit, count - limit, "WITHSCORES")
+        waits[i] = math.max(tonumber(oldest[2]) + length - now, 1)
+        full = true
+    end
+end
+if full then
+    return waits
+end
+for i, key in ipairs(KEYS) do
+    redis.call("ZADD", key, now, ARGV[2])
+    redis.call("PEXPIRE", key, ARGV[2 + 2 * i])
+end
+return {}
+"""
+_sliding_window = None
+
+# Stores a cached value unless it was invalidated since the generation was
+# read. KEYS: value, generation counter. ARGV: generation read before loading
+# the value ("" if none), seconds to live, value.
+FILL_CACHE_SCRIPT = """
+if (redis.call("GET", KEYS[2]) or "") ~= ARGV[1] then
+    return 0
+end
+redis.call("SET", KEYS[1], ARGV[3], "EX", ARGV[2])
+return 1
+"""
+_fill_cache = None
 
 
 class RedisAdapter(object):
-    """Creates and maintains a connection to the redis database"""
+    """Provides access to a namespace of the redis database
 
-    def __init__(self, database):
-        redis_address = config.REDIS.split(":")
-        redis_host = redis_address[0]
-        if len(redis_address) > 0:
-            redis_port = redis_address[1]
-        else:
-            redis_port = 6379
-        self.db = redis.StrictRedis(host=redis_host, port=redis_port, db=0)
+    Values are stored as plain strings by default. With hash_values set, each
+    value is stored as a redis hash with one entry per field, which requires a
+    codec providing dumps_fields() and loads_fields().
+    """
+
+    def __init__(self, database, codec=None, hash_values=False):
+        self.db = get_client()
+        # Converts stored values to bytes and back, pickle unless specified
+        self.codec = codec if codec is not None else PickleCodec()
+        self.hash_values = hash_values
+        self.mgmt_prefix, self.var_prefix = key_prefixes(database)
         database = "bluquist_" + config.ENVIRONMENT + "_" + str(database)
         self.databases_key = "_dbs"
-        self.db.sadd(self.databases_key, database)
-
-        self.mgmt_prefix = database + "_m_"
-        self.var_prefix = database + "_v_"
 
         self.lock_key = self.mgmt_prefix + "locks"
-        self.keylist_key = self.mgmt_prefix + "keys"
 
-        self.keylock = self.db.lock(self.keylist_key + "_lock")
+        # The namespace only has to be registered once per process
+        if database not in _registered_databases:
+            pipe = self.db.pipeline(transaction=False)
+            pipe.sadd(self.databases_key, database)
+            # Key lists were replaced by EXISTS queries, drop leftovers
+            pipe.unlink(self.mgmt_prefix + "keys")
+            pipe.execute()
+            _registered_databases.add(database)
+
+    @metrics.timed("redis")
+    def set(self, key, value, expire_at=None):
+        name = self.var_prefix + str(key)
+        if self.hash_values:
+            pipe = self.db.pipeline(transaction=True)
+            pipe.delete(name)
+            pipe.hset(name, mapping=self.codec.dumps_fields(value))
+        elif expire_at is not None:
+            pipe = self.db.pipeline(transaction=True)
+            pipe.set(name, self.codec.dumps(value))
+        else:
+            self.db.set(name, self.codec.dumps(value))
+            return
+        if expire_at is not None:
+            pipe.expireat(name, expire_at)
+        pipe.execute()
+
+    @metrics.timed("redis")
+    def update(self, key, fields, expire_at=None):
+        """Updates single fields of a stored hash value
 
-    def set(self, key, value):
-        self.keylock.acquire()
-        try:
-            self.db.sadd(self.keylist_key, str(key))
-            self.db.set(self.var_prefix + str(key), pickle.dumps(value))
-        finally:
-            self.keylock.release()
+        Nothing is written if the value does not exist (anymore). Returns
+        whether the value was updated.
+        """
+        global _update_fields
+        if not self.hash_values:
+            raise TypeError("Only hash values support field updates")
+        if _update_fields is None:
+            _update_fields = self.db.register_script(UPDATE_FIELDS_SCRIPT)
 
+        args = ["" if expire_at is None else int(expire_at)]
+        for field, value in self.codec.dumps_fields(fields).items():
+            args.extend((field, value))
+        return bool(
+            _update_fields(keys=[self.var_prefix + str(key)], args=args, client=self.db)
+        )
+
+    @metrics.timed("redis")
     def expire(self, key, seconds):
         self.db.expireat(self.var_prefix + str(key), seconds)
-        # Cannot provide key exist queries for expiring keys at the moment
-        self.db.srem(self.keylist_key, str(key))
 
     def get(self, key):
-        raw_val = self.db.get(self.var_prefix + str(key))
-        if raw_val is not None:
-            return pickle.loads(raw_val)
+        return self.get_with_ttl(key)[0]
+
+    @metrics.timed("redis")
+    def get_with_ttl(self, key):
+        """Returns a value together with its remaining time to live in seconds
+
+        The TTL is -1 for keys without an expiration date.
+        """
+        name = self.var_prefix + str(key)
+        pipe = self.db.pipeline(transaction=False)
+        if self.hash_values:
+            pipe.hgetall(name)
+        else:
+            pipe.get(name)
+        pipe.ttl(name)
+        raw_val, ttl = pipe.execute(raise_on_error=False)
+
+        if self.hash_values and isinstance(raw_val, redis.ResponseError):
+            # Values written before switching to hashes are plain strings
+            raw_val = self.db.get(name)
+            if raw_val is None:
+                return None, None
+            return self.codec.loads(raw_val), ttl
+        elif isinstance(raw_val, Exception):
+            raise raw_val
+        elif not raw_val:
+            return None, None
+        elif self.hash_values:
+            return self.codec.loads_fields(raw_val), ttl
         else:
-            return None
+            return self.codec.loads(raw_val), ttl
 
+    @metrics.timed("redis")
     def unset(self, key):
-        self.keylock.acquire()
-        try:
-            self.db.srem(self.keylist_key, str(key))
-            self.db.delete(self.var_prefix + str(key))
-        finally:
-            self.keylock.release()
+        self.db.delete(self.var_prefix + str(key))
 
+    @metrics.timed("redis")
     def exists(self, key):
-        return self.db.sismember(self.keylist_key, str(key))
+        return self.db.exists(self.var_prefix + str(key)) == 1
+
+    @metrics.timed("redis")
+    def push(self, key, *values):
+        """Appends values to the end of a list"""
+        self.db.rpush(self.var_prefix + str(key), *map(self.codec.dumps, values))
+
+    @metrics.timed("redis")
+    def claim(self, key, processing_key, count=1, timeout=None):
+        """Moves up to count values from the head of a list to a processing list
+
+        The values are returned and stay at the end of the processing list
+        until it is unset, so they are not lost if the caller stops before
+        handling them. With a timeout, waits up to timeout seconds for the
+        first value.
+        """
+        name = self.var_prefix + str(key)
+        processing = self.var_prefix + str(processing_key)
+        values = []
+        if timeout is not None:
+            value = self.db.blmove(name, processing, timeout, "LEFT", "RIGHT")
+            if value is None:
+                return values
+            values.append(value)
+            count -= 1
+        if count > 0:
+            pipe = self.db.pipeline(transaction=False)
+            for _ in range(count):
+                pipe.lmove(name, processing, "LEFT", "RIGHT")
+            values.extend(v for v in pipe.execute() if v is not None)
+        return [self.codec.loads(v) for v in values]
+
+    @metrics.timed("redis")
+    def requeue(self, processing_key, key):
+        """Moves all values of a processing list back to the head of a list
+
+        Returns the number of values moved, their order is kept.
+        """
+        name = self.var_prefix + str(key)
+        processing = self.var_prefix + str(processing_key)
+        moved = 0
+        while self.db.lmove(processing, name, "RIGHT", "LEFT") is not None:
+            moved += 1
+        return moved
+
+    @metrics.timed("redis")
+    def peek(self, key):
+        """Returns the value at the head of a list without removing it"""
+        raw_val = self.db.lindex(self.var_prefix + str(key), 0)
+        return None if raw_val is None else self.codec.loads(raw_val)
+
+    @metrics.timed("redis")
+    def length(self, key):
+        return self.db.llen(self.var_prefix + str(key))
+
+    @metrics.timed("redis")
+    def add_to_counters(self, key, fields):
+        """Increments the fields of a hash of counters"""
+        name = self.var_prefix + str(key)
+        pipe = self.db.pipeline(transaction=False)
+        for field, amount in fields.items():
+            pipe.hincrbyfloat(name, field, amount)
+        pipe.execute()
+
+    @metrics.timed("redis")
+    def get_counters(self, key):
+        return self.db.hgetall(self.var_prefix + str(key))
+
+    @metrics.timed("redis")
+    def get_cached(self, key):
+        """Returns a cached value, None if it is not cached, and the generation
+
+        The generation has to be passed to fill_cache() if the value is not
+        cached.
+        """
+        pipe = self.db.pipeline(transaction=False)
+        pipe.get(self.var_prefix + str(key))
+        pipe.get(self.mgmt_prefix + "generation_" + str(key))
+        value, generation = pipe.execute()
+        return value, generation
+
+    @metrics.timed("redis")
+    def fill_cache(self, key, value, generation, expire):
+        """Caches a value unless invalidate_cache() was called since reading generation
+
+        Returns whether the value was cached.
+        """
+        global _fill_cache
+        if _fill_cache is None:
+            _fill_cache = self.db.register_script(FILL_CACHE_SCRIPT)
+
+        return bool(
+            _fill_cache(
+                keys=[
+                    self.var_prefix + str(key),
+                    self.mgmt_prefix + "generation_" + str(key),
+                ],
+                args=[generation or "", int(expire), value],
+                client=self.db,
+            )
+        )
+
+    @metrics.timed("redis")
+    def invalidate_cache(self, keys, expire):
+        """Drops cached values and keeps fills started before from storing them"""
+        pipe = self.db.pipeline(transaction=True)
+        for key in keys:
+            generation = self.mgmt_prefix + "generation_" + str(key)
+            pipe.incr(generation)
+            # Fills take far less time than this
+            pipe.expire(generation, int(expire))
+            pipe.delete(self.var_prefix + str(key))
+        pipe.execute()
+
+    @metrics.timed("redis")
+    def add_scored(self, key, member, score, drop_below=None):
+        """Adds a member to a sorted set, dropping members scored below drop_below"""
+        name = self.var_prefix + str(key)
+        pipe = self.db.pipeline(transaction=False)
+        pipe.zadd(name, {member: score})
+        if drop_below is not None:
+            pipe.zremrangebyscore(name, "-inf", "(%r" % drop_below)
+        pipe.execute()
+
+    @metrics.timed("redis")
+    def get_scored(self, key, min_score="-inf"):
+        """Returns the (member, score) pairs of a sorted set scored at least min_score"""
+        return self.db.zrangebyscore(
+            self.var_prefix + str(key), min_score, "+inf", withscores=True
+        )
+
+    @metrics.timed("redis")
+    def hit_windows(self, windows, now, member):
+        """Records a request in sliding windows of (key, limit, seconds)
+
+        Nothing is recorded if any window is full. Returns the seconds until
+        each window has room again, an empty list if the request was recorded.
+        """
+        global _sliding_window
+        if _sliding_window is None:
+            _sliding_window = self.db.register_script(SLIDING_WINDOW_SCRIPT)
+
+        keys = []
+        args = [int(now * 1000), member]
+        for key, limit, seconds in windows:
+            keys.append(self.var_prefix + str(key))
+            args.extend((limit, int(seconds * 1000)))
+        waits = _sliding_window(keys=keys, args=args, client=self.db)
+        return [wait / 1000 for wait in waits]
+
+    @metrics.timed("redis")
+    def publish(self, channel, message):
+        self.db.publish(self.mgmt_prefix + channel, message)
+
+    def pubsub(self):
+        return self.db.pubsub(ignore_subscribe_messages=True)
@@ -0,0 +1,154 @@
+""" Session cache
+
+Per process LRU cache of validated sessions. Entries are dropped after a
+short TTL, when any worker destroys or rewrites the session (announced on a
+redis channel) and when redis expires or evicts the session key (keyspace
+notification). The notifications have to be enabled when deploying redis
+(notify-keyspace-events containing "Exe"), the cache only checks the setting.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import redis
+from RedisAdapter import RedisAdapter
+
+log = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "invalidate"
+EXPIRED_EVENTS = ("__keyevent@0__:expired", "__keyevent@0__:evicted")
+# notify-keyspace-events flags the expired events need, "A" stands for "xe"
+REQUIRED_EVENT_FLAGS = ("E", "x", "e")
+
+
+class SessionCache(object):
+    """Bounded cache mapping session tokens to (session, expire date)"""
+
+    def __init__(self, database, size, ttl):
+        self.database = database
+        self.size = size
+        self.ttl = ttl
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._adapter = None
+        self._listener_pid = None
+        # Entries are only served while invalidations are being received
+        self._listening = False
+
+    def get(self, token):
+        """Returns a copy of the cached session and its expire date or None"""
+        self._ensure_listener()
+        if not self._listening:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            session, expire_date, cached_at = entry
+            if cached_at + self.ttl < time.time() or expire_date <= time.time():
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+        return dict(session), expire_date
+
+    def put(self, token, session, expire_date):
+        if not self._listening:
+            return
+
+        with self._lock:
+            self._entries[token] = (dict(session), expire_date, time.time())
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def refresh(self, token, expire_date):
+        """Updates the expire date of a cached session after a TTL refresh"""
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                self._entries[token] = (entry[0], expire_date, entry[2])
+
+    def invalidate(self, token):
+        """Drops a session from the caches of all workers"""
+        self._drop(str(token))
+        if self._adapter is not None:
+            self._adapter.publish(INVALIDATION_CHANNEL, str(token))
+
+    def _drop(self, token):
+        with self._lock:
+            self._entries.pop(token, None)
+
+    def _clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _ensure_listener(self):
+        # The listener thread does not survive a fork, start one per process
+        if self._listener_pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._listener_pid = os.getpid()
+            self._listening = False
+            self._entries.clear()
+            self._adapter = RedisAdapter(self.database)
+            thread = threading.Thread(
+                target=self._listen, name="session-cache", daemon=True
+            )
+            thread.start()
+
+    def _listen(self):
+        adapter = self._adapter
+        channel = adapter.mgmt_prefix + INVALIDATION_CHANNEL
+        _check_notifications(adapter.db)
+
+        while True:
+            pubsub = adapter.pubsub()
+            try:
+                pubsub.subscribe(channel, *EXPIRED_EVENTS)
+                # Invalidations may have been missed while disconnected
+                self._clear()
+                self._listening = True
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is None:
+                        continue
+                    data = message["data"].decode("utf-8")
+                    if message["channel"].decode("utf-8") == channel:
+                        self._drop(data)
+                    elif data.startswith(adapter.var_prefix):
+                        self._drop(data[len(adapter.var_prefix) :])
+            except redis.RedisError:
+                log.exception("Session cache lost its invalidation subscription")
+            finally:
+                self._listening = False
+                pubsub.close()
+            time.sleep(1)
+
+
+def _check_notifications(db):
+    """Warns when redis does not announce expired and evicted keys"""
+    try:
+        flags = db.config_get("notify-keyspace-events").get(
+            "notify-keyspace-events", ""
+        )
+    except redis.RedisError:
+        log.warning("Cannot read notify-keyspace-events of redis")
+        return
+    if isinstance(flags, bytes):
+        flags = flags.decode("utf-8")
+    if "A" in flags:
+        flags += "xe"
+    missing = [flag for flag in REQUIRED_EVENT_FLAGS if flag not in flags]
+    if missing:
+        log.warning(
+            "notify-keyspace-events of redis lacks %s, sessions dropped by "
+            "redis may stay cached until the cache TTL",
+            "".join(missing),
+        )
@@ -0,0 +1,114 @@
+""" Token denylist
+
+Signed session tokens stay valid until they expire, unless their ID is on
+the denylist. Revoked IDs are stored in a redis sorted set scored by the
+revocation time. Every process keeps a copy of the set and fetches the IDs
+revoked since its last sync in the background, so checking a token needs
+no redis call. Entries are dropped once the tokens they revoke have expired.
+A process that could not sync for longer than max_age seconds considers its
+copy outdated, so callers can refuse tokens instead of missing revocations.
+"""
+
+import os
+import time
+import logging
+import threading
+
+from RedisAdapter import RedisAdapter
+
+log = logging.getLogger(__name__)
+
+REVOKED_KEY = "revoked"
+# Seconds the clocks of workers may differ, revocations written with a
+# slightly older time than the last one seen are still fetched
+CLOCK_SKEW = 30
+
+
+class TokenDenylist(object):
+    """Set of revoked token IDs shared by all workers"""
+
+    def __init__(self, database, lifetime, interval, max_age):
+        self.database = database
+        # Revocations older than the token lifetime no longer matter
+        self.lifetime = lifetime
+        self.interval = interval
+        self.max_age = max_age
+
+        # Revocation times by token ID, replaced as a whole when pruned
+        self._revoked = {}
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._synced_until = None
+        # Monotonic time of the last successful sync
+        self._synced_at = None
+        self._syncer_pid = None
+
+    def __contains__(self, token_id):
+        self._ensure_syncer()
+        return token_id in self._revoked
+
+    def is_current(self):
+        """Checks whether the copy of this process was synced recently"""
+        self._ensure_syncer()
+        synced_at = self._synced_at
+        return synced_at is not None and time.monotonic() - synced_at <= self.max_age
+
+    def revoke(self, token_id):
+        """Adds a token ID to the denylists of all workers"""
+        now = time.time()
+        with self._lock:
+            self._revoked[token_id] = now
+        RedisAdapter(self.database).add_scored(
+            REVOKED_KEY, token_id, now, drop_below=now - self.lifetime
+        )
+
+    def sync(self):
+        """Fetches the token IDs revoked since the last sync"""
+        started = time.monotonic()
+        now = time.time()
+        if self._synced_until is None:
+            since = now - self.lifetime
+        else:
+            since = self._synced_until - CLOCK_SKEW
+        entries = RedisAdapter(self.database).get_scored(REVOKED_KEY, since)
+
+        with self._lock:
+            revoked = {
+                token_id: revoked_at
+                for token_id, revoked_at in self._revoked.items()
+                if revoked_at >= now - self.lifetime
+            }
+            for token_id, revoked_at in entries:
+                revoked[token_id.decode("utf-8")] = revoked_at
+            if entries:
+                self._synced_until = max(self._synced_until or 0, entries[-1][1])
+            elif self._synced_until is None:
+                self._synced_until = since
+            self._revoked = revoked
+            self._synced_at = started
+
+    def _sync_periodically(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sync()
+            except Exception:
+                log.exception("Failed to sync the token denylist")
+
+    def _ensure_syncer(self):
+        # The sync thread does not survive a fork, start one per process
+        if self._syncer_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._syncer_pid == os.getpid():
+                return
+            try:
+                # Checks wait for the current list, is_current() stays false
+                # until a sync succeeds
+                self.sync()
+            except Exception:
+                log.exception("Failed to load the token denylist")
+            threading.Thread(
+                target=self._sync_periodically, name="token-denylist", daemon=True
+            ).start()
+            self._syncer_pid = os.getpid()
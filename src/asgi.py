@@ -0,0 +1,482 @@
+""" ASGI server entry point
+
+Serves the API on an asyncio event loop, e.g. "uvicorn asgi:application".
+The hot read-only routes (ping, user info and the info of a single team)
+are answered on the event loop with async redis and MongoDB clients, so
+one process can keep hundreds of them waiting on I/O. They share the
+session checks and session cache of auth, the team access cache of
+controller.team, the team payload cache and the error codes with the Flask
+routes. Team access missing in the cache is loaded by the controller on
+the thread pool. Their request and authentication times are recorded by
+metrics like those of the Flask routes, their redis and MongoDB calls are
+not. Every other request is passed to the Flask app of main.py, which runs
+on a bounded thread pool with all its hooks and error handlers. server.py
+keeps serving the Flask app over WSGI.
+
+Needs motor, uvicorn, and redis 5 or later for redis.asyncio.
+"""
+
+import io
+import sys
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import redis
+import redis.asyncio
+from bson import ObjectId
+from bson.errors import InvalidId
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import auth
+import config
+import metrics
+import serializer
+from controller import team as team_controller
+from controller.team import MEMBER, MEMBER_PROJECTION
+from error import APIException
+from main import BASE_ROUTE, app, policies
+from model.Team import Team, TeamMembership
+from model.User import User, UserRole
+from RedisAdapter import UPDATE_FIELDS_SCRIPT, key_prefixes, parse_address
+from routes.team.route import AccessDeniedError, TeamNotExistError
+from util import encode_body, resolve_request_ip
+
+log = logging.getLogger(__name__)
+
+
+class Request(object):
+    """The parts of an ASGI HTTP scope the native routes need"""
+
+    def __init__(self, scope):
+        self.headers = {}
+        self.forwarded_for = []
+        for name, value in scope["headers"]:
+            name = name.decode("latin-1")
+            value = value.decode("latin-1")
+            if name == "x-forwarded-for":
+                self.forwarded_for.append(value)
+            self.headers.setdefault(name, value)
+        self.args = parse_qs(scope["query_string"].decode("latin-1"))
+        client = scope.get("client")
+        self.remote_addr = client[0] if client else None
+        # Renewed token of a signed session, sent back in a response header
+        self.session_token = None
+
+    def arg(self, name):
+        values = self.args.get(name)
+        return values[0] if values else None
+
+    @property
+    def ip(self):
+        # No proxy headers are evaluated beyond X-Forwarded-For, like the
+        # access route of werkzeug
+        return resolve_request_ip(
+            self.forwarded_for, [self.remote_addr], self.remote_addr
+        )
+
+
+class AsyncSessionStore(object):
+    """Async access to the sessions auth stores through RedisAdapter"""
+
+    def __init__(self, client):
+        self.db = client
+        self.codec = auth.session_codec
+        self.hash_values = config.SESSION_STORE == "hash"
+        _, self.var_prefix = key_prefixes(auth.SESSION_DATABASE)
+        self._update_fields = client.register_script(UPDATE_FIELDS_SCRIPT)
+
+    async def load(self, token):
+        """Returns the stored session and its expire date, like auth._load_session"""
+        if auth._session_cache is not None:
+            cached = auth._session_cache.get(token)
+            if cached is not None:
+                return cached
+
+        name = self.var_prefix + str(token)
+        async with self.db.pipeline(transaction=False) as pipe:
+            if self.hash_values:
+                pipe.hgetall(name)
+            else:
+                pipe.get(name)
+            pipe.ttl(name)
+            raw_val, ttl = await pipe.execute(raise_on_error=False)
+
+        if self.hash_values and isinstance(raw_val, redis.ResponseError):
+            # Values written before switching to hashes are plain strings
+            raw_val = await self.db.get(name)
+            if raw_val is None:
+                return None, None
+            session = self.codec.loads(raw_val)
+        elif isinstance(raw_val, Exception):
+            raise raw_val
+        elif not raw_val:
+            return None, None
+        elif self.hash_values:
+            session = self.codec.loads_fields(raw_val)
+        else:
+            session = self.codec.loads(raw_val)
+
+        if ttl >= 0:
+            expire_date = time.time() + ttl
+        else:
+            expire_date = session["expireDate"]
+        if auth._session_cache is not None:
+            auth._session_cache.put(token, session, expire_date)
+        return session, expire_date
+
+    async def refresh(self, token, expire_date):
+        name = self.var_prefix + str(token)
+        if self.hash_values:
+            args = [int(expire_date)]
+            for field, value in self.codec.dumps_fields(
+                {"expireDate": expire_date}
+            ).items():
+                args.extend((field, value))
+            await self._update_fields(keys=[name], args=args)
+        else:
+            await self.db.expireat(name, int(expire_date))
+
+    async def destroy(self, token):
+        await self.db.delete(self.var_prefix + str(token))
+        if auth._session_cache is not None:
+            auth._session_cache.invalidate(token)
+
+
+class Application(object):
+    """ASGI application with native routes and the Flask app as fallback"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(
+            max_workers=config.ASGI_WSGI_THREADS, thread_name_prefix="wsgi"
+        )
+        # Native routes with the endpoints of their Flask routes
+        self.routes = {}
+        if config.ASGI_NATIVE_ROUTES:
+            self.routes = {
+                ("GET", BASE_ROUTE + "/static/ping"): (
+                    self.ping,
+                    "static.ping_backend",
+                ),
+                ("GET", BASE_ROUTE + "/user/info"): (
+                    self.user_info,
+                    "user.get_user_data",
+                ),
+                ("GET", BASE_ROUTE + "/team/info"): (
+                    self.team_info,
+                    "team.get_team_info",
+                ),
+            }
+        self.sessions = None
+        self.mongo = None
+        _, self.access_prefix = key_prefixes(team_controller.ACCESS_DATABASE)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+
+        route = None
+        if scope["type"] == "http":
+            route = self.routes.get((scope["method"], scope["path"]))
+        if route is not None:
+            route, endpoint = route
+            request = Request(scope)
+            start = time.perf_counter()
+            try:
+                result = await route(request)
+            except APIException as e:
+                result = error_response(e.status_code, e.error_code, e.encode())
+            except Exception:
+                log.exception("Request failed")
+                result = error_response(
+                    500,
+                    -1,
+                    encode_body(
+                        error_code=-1,
+                        error_message="The service encountered an unforeseen server error.",
+                    ),
+                )
+            if result is not None:
+                await self.send_response(request, send, *result)
+                if config.METRICS_ENABLED:
+                    metrics.record("request", endpoint, time.perf_counter() - start)
+                return
+        await self.call_wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.connect()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.sessions is not None:
+                    await self.sessions.db.aclose()
+                    self.mongo.client.close()
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def connect(self):
+        """Creates the async clients on the running event loop"""
+        if self.sessions is not None:
+            return
+        host, port = parse_address(config.REDIS)
+        client = redis.asyncio.StrictRedis(
+            host=host,
+            port=port,
+            db=0,
+            max_connections=config.ASGI_REDIS_MAX_CONNECTIONS,
+            socket_timeout=config.REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=config.REDIS_CONNECT_TIMEOUT,
+        )
+        self.sessions = AsyncSessionStore(client)
+        self.mongo = AsyncIOMotorClient(config.MONGO).get_default_database()
+
+    async def send_response(self, request, send, status, body, headers):
+        headers = headers + [(b"content-length", str(len(body)).encode("latin-1"))]
+        if request.session_token is not None:
+            headers.append(
+                (
+                    auth.SESSION_TOKEN_HEADER.lower().encode("latin-1"),
+                    request.session_token.encode("latin-1"),
+                )
+            )
+        if "origin" in request.headers:
+            # Same as flask_cors with the settings of main.py
+            headers.append((b"access-control-allow-origin", b"*"))
+            headers.append(
+                (
+                    b"access-control-expose-headers",
+                    auth.SESSION_TOKEN_HEADER.encode("latin-1"),
+                )
+            )
+        await send(
+            {"type": "http.response.start", "status": status, "headers": headers}
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    async def authenticate(self, request, endpoint):
+        """Loads and checks the session of a request, like auth.authenticate"""
+        start = time.perf_counter()
+        try:
+            return await self._authenticate(request, endpoint)
+        finally:
+            if config.METRICS_ENABLED:
+                metrics.record("authenticate", endpoint, time.perf_counter() - start)
+
+    async def _authenticate(self, request, endpoint):
+        roles = policies[endpoint].roles
+        token = auth.parse_authorization(request.headers.get("authorization"))
+        if auth.is_signed_token(token):
+            # Checked without redis, expired tokens need not be revoked
+            session, expire_date = auth.load_signed_session(token)
+            session = auth.check_session(session, expire_date, request.ip, roles)
+            request.session_token = auth.renew_signed_token(session)
+            return session
+
+        session, expire_date = await self.sessions.load(token)
+        try:
+            session = auth.check_session(session, expire_date, request.ip, roles)
+        except auth.SessionExpiredError:
+            await self.sessions.destroy(token)
+            raise
+
+        # Saved right away, the native routes do not modify sessions
+        if session["userRole"] != UserRole.APP and session.needs_refresh():
+            await self.sessions.refresh(token, session["expireDate"])
+            if auth._session_cache is not None:
+                auth._session_cache.refresh(str(token), session["expireDate"])
+        return session
+
+    async def ping(self, request):
+        return 204, b"", [(b"content-type", b"text/html; charset=utf-8")]
+
+    async def user_info(self, request):
+        self.connect()
+        session = await self.authenticate(request, "user.get_user_data")
+        u = await self.mongo[User._get_collection_name()].find_one(
+            {"_id": ObjectId(session["userID"])},
+            {"mail": True, "first_name": True, "last_name": True},
+        )
+        if u is None:
+            raise User.DoesNotExist()
+
+        payload = {"mail": u["mail"]}
+        if u.get("first_name") is not None:
+            payload["first_name"] = u["first_name"]
+        if u.get("last_name") is not None:
+            payload["last_name"] = u["last_name"]
+        return json_response(serializer.dumps(payload))
+
+    async def team_info(self, request):
+        team_id = request.arg("team_id")
+        if not team_id:
+            # The team listing streams from a cursor in the Flask route
+            return None
+
+        self.connect()
+        session = await self.authenticate(request, "team.get_team_info")
+        if session["userRole"] == UserRole.APP:
+            user_id = None
+        else:
+            user_id = str(session["userID"])
+
+        try:
+            team_oid = ObjectId(team_id)
+        except (InvalidId, TypeError):
+            raise TeamNotExistError()
+        teams = self.mongo[Team._get_collection_name()]
+
+        version = await self.team_version(team_oid, user_id)
+        if version is None:
+            if user_id is not None and await teams.find_one(
+                {"_id": team_oid}, {"_id": True}
+            ):
+                raise AccessDeniedError()
+            raise TeamNotExistError()
+
+        payload = serializer.get_team_payload(team_id, version)
+        if payload is None:
+            raw = await teams.find_one({"_id": team_oid})
+            if raw is None:
+                raise TeamNotExistError()
+            if config.TEAM_MEMBERSHIP_STORAGE == "collection":
+                raw["members"] = await (
+                    self.mongo[TeamMembership._get_collection_name()]
+                    .find({"team_id": team_oid}, MEMBER_PROJECTION)
+                    .sort("_id", 1)
+                    .to_list(None)
+                )
+            payload = serializer.put_team_payload(team_id, raw)
+        return json_response(payload)
+
+    async def team_version(self, team_oid, user_id):
+        """Same as controller.team.get_team_version_for_user"""
+        query = {"_id": team_oid}
+        if user_id is not None and config.TEAM_ACCESS_CACHE_ENABLED:
+            if MEMBER not in await self.team_access(str(team_oid), user_id):
+                return None
+        elif user_id is not None:
+            if config.TEAM_MEMBERSHIP_STORAGE == "collection":
+                membership = await self.mongo[
+                    TeamMembership._get_collection_name()
+                ].find_one({"team_id": team_oid, "user_id": user_id}, {"_id": True})
+                if membership is None:
+                    return None
+            else:
+                query["members.user_id"] = user_id
+        t = await self.mongo[Team._get_collection_name()].find_one(
+            query, {"version": True}
+        )
+        return None if t is None else t.get("version", 0)
+
+    async def team_access(self, team_id, user_id):
+        """Access flags of a user to a team, same as controller.team.get_access"""
+        key = team_controller.access_key(team_id, user_id)
+        access = await self.sessions.db.get(self.access_prefix + key)
+        if access is not None:
+            return access.decode("utf-8")
+        # Loaded and cached by the controller, which guards against racing
+        # invalidations
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, team_controller.get_access, team_id, user_id
+        )
+
+    async def call_wsgi(self, scope, receive, send):
+        """Runs the Flask app for a request on the thread pool"""
+        if scope["type"] != "http":
+            raise ValueError("Unsupported ASGI scope " + scope["type"])
+
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            body.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+
+        loop = asyncio.get_running_loop()
+        environ = wsgi_environ(scope, b"".join(body))
+        await loop.run_in_executor(self.executor, self.run_wsgi, environ, send, loop)
+
+    def run_wsgi(self, environ, send, loop):
+        """Streams the response of the Flask app back to the event loop"""
+
+        def emit(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response_start = {}
+
+        def start_response(status, headers, exc_info=None):
+            response_start["status"] = int(status.split(" ", 1)[0])
+            response_start["headers"] = [
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in headers
+            ]
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            emit(dict(type="http.response.start", **response_start))
+            for chunk in result:
+                if chunk:
+                    emit(
+                        {"type": "http.response.body", "body": chunk, "more_body": True}
+                    )
+            emit({"type": "http.response.body", "body": b""})
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+
+def json_response(payload, status=200):
+    """Response tuple around an encoded payload, like util.encoded_response"""
+    headers = [(b"content-type", b"application/json")]
+    return status, b'{"payload":' + payload + b"}\n", headers
+
+
+def error_response(status, error_code, body):
+    """Response tuple of an encoded error, like util.response"""
+    headers = [
+        (b"content-type", b"application/json"),
+        (b"x-errorcode", str(error_code).encode("latin-1")),
+    ]
+    return status, body, headers
+
+
+def wsgi_environ(scope, body):
+    """Builds the WSGI environment of an ASGI HTTP request"""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client")
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": client[0] if client else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+            environ[name] = value
+            continue
+        key = "HTTP_" + name
+        environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+application = Application(app)
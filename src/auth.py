@@ -5,10 +5,18 @@ requests.
 """
 
 from flask import request, g
+import base64
+import hashlib
+import hmac
+import json
 import time
 import uuid
-from functools import wraps
+import config
+import metrics
 from RedisAdapter import RedisAdapter
+from SessionCache import SessionCache
+from TokenDenylist import TokenDenylist
+from codec import SessionCodec
 from error import APIException
 from model.User import UserRole
 
@@ -16,81 +24,324 @@ from util import get_request_ip
 
 _public_paths = []
 
+SESSION_DATABASE = "sessions"
+# Response header with the renewed token of a signed session
+SESSION_TOKEN_HEADER = "X-Session-Token"
+session_codec = SessionCodec()
+
+
+def _session_store():
+    return RedisAdapter(
+        SESSION_DATABASE,
+        codec=session_codec,
+        hash_values=config.SESSION_STORE == "hash",
+    )
+
+
+if config.SESSION_CACHE_ENABLED:
+    _session_cache = SessionCache(
+        SESSION_DATABASE, config.SESSION_CACHE_SIZE, config.SESSION_CACHE_TTL
+    )
+else:
+    _session_cache = None
+
+
+if config.SESSION_TOKEN_MODE == "signed" and not config.SESSION_TOKEN_SECRET:
+    raise RuntimeError("Signed session tokens require SESSION_TOKEN_SECRET to be set")
+
+# Signed tokens are revoked on logout, see TokenDenylist.py
+token_denylist = TokenDenylist(
+    SESSION_DATABASE,
+    config.SESSION_TOKEN_LIFETIME,
+    config.SESSION_REVOCATION_SYNC_INTERVAL,
+    config.SESSION_REVOCATION_MAX_AGE,
+)
+
 
 def _get_request_ip():
     return get_request_ip()
 
 
+class Session(dict):
+    """Session information which keeps track of modifications
+
+    Only modified sessions are written back to redis after a request, for all
+    other sessions the expiration date of the stored entry is extended.
+    """
+
+    def __init__(self, *args, stored_expire_date=None, **kw):
+        super(Session, self).__init__(*args, **kw)
+        self.modified = False
+        # Expiration date of the entry currently stored in redis
+        self.stored_expire_date = stored_expire_date
+
+    def __setitem__(self, key, value):
+        self.modified = True
+        super(Session, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.modified = True
+        super(Session, self).__delitem__(key)
+
+    def clear(self):
+        self.modified = True
+        super(Session, self).clear()
+
+    def pop(self, *args):
+        self.modified = True
+        return super(Session, self).pop(*args)
+
+    def popitem(self):
+        self.modified = True
+        return super(Session, self).popitem()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.modified = True
+        return super(Session, self).setdefault(key, default)
+
+    def update(self, *args, **kw):
+        self.modified = True
+        super(Session, self).update(*args, **kw)
+
+    def touch(self):
+        """Extends the session lifetime without marking it as modified"""
+        if "tokenID" in self:
+            lifetime = config.SESSION_TOKEN_LIFETIME
+        else:
+            lifetime = config.SESSION_LIFETIME
+        super(Session, self).__setitem__("expireDate", time.time() + lifetime)
+
+    def needs_refresh(self):
+        """Checks whether the stored expiration date has to be extended"""
+        return (
+            self["expireDate"] - self.stored_expire_date
+            >= config.SESSION_REFRESH_INTERVAL
+        )
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _signature(payload):
+    return hmac.new(
+        config.SESSION_TOKEN_SECRET.encode("utf-8"),
+        payload.encode("ascii"),
+        hashlib.sha256,
+    ).digest()
+
+
+def is_signed_token(token):
+    """Checks whether a token carries its session instead of referencing it"""
+    return "." in str(token)
+
+
+def sign_token(claims):
+    """Returns a token carrying the given session claims"""
+    payload = _b64encode(
+        json.dumps(claims, separators=(",", ":"), sort_keys=True).encode("utf-8")
+    )
+    return payload + "." + _b64encode(_signature(payload))
+
+
+def verify_token(token):
+    """Returns the claims of a signed token, None if it was not signed by us"""
+    if not config.SESSION_TOKEN_SECRET:
+        return None
+    payload, _, signature = token.partition(".")
+    try:
+        if not hmac.compare_digest(_b64decode(signature), _signature(payload)):
+            return None
+        claims = json.loads(_b64decode(payload))
+    except ValueError:
+        return None
+    return claims if isinstance(claims, dict) else None
+
+
+def load_signed_session(token):
+    """Returns the session of a signed token and its expire date, like _load_session
+
+    Checking the token does not need redis, only the denylist of revoked
+    tokens is synced in the background.
+    """
+    claims = verify_token(token)
+    if claims is None:
+        return None, None
+    if not token_denylist.is_current():
+        # Revoked tokens would pass while the denylist is outdated
+        raise SessionsUnavailableError()
+    if claims["tokenID"] in token_denylist:
+        return None, None
+    claims["sessionToken"] = token
+    return claims, claims["expireDate"]
+
+
 def start_session(user_id, user_role):
     """Starts a new session for the given user ID"""
+    if config.SESSION_TOKEN_MODE == "signed":
+        return sign_token(
+            {
+                "userID": str(user_id),
+                "userRole": user_role,
+                "clientIP": _get_request_ip(),
+                # Extended by renewed tokens, see renew_signed_token()
+                "expireDate": int(time.time() + config.SESSION_TOKEN_LIFETIME),
+                "tokenID": uuid.uuid4().hex,
+            }
+        )
+
     token = uuid.uuid4()
     session = {
         "userID": user_id,
         "userRole": user_role,
         "clientIP": _get_request_ip(),
         # New sessions will expire after 30 minutes of inactivity
-        "expireDate": time.time() + (60 * 30),
+        "expireDate": time.time() + config.SESSION_LIFETIME,
         "sessionToken": token,
     }
 
-    redis = RedisAdapter("sessions")
-    redis.set(token, session)
-    redis.expire(token, int(session["expireDate"]))
+    redis = _session_store()
+    redis.set(token, session, expire_at=int(session["expireDate"]))
     return token
 
 
 def destroy_session(session_id):
     """Destroys the given session"""
-    redis = RedisAdapter("sessions")
+    if is_signed_token(session_id):
+        claims = verify_token(session_id)
+        if claims is not None and claims["expireDate"] > time.time():
+            token_denylist.revoke(claims["tokenID"])
+        g.session = None
+        return
+
+    redis = _session_store()
     redis.unset(session_id)
+    if _session_cache is not None:
+        _session_cache.invalidate(session_id)
     g.session = None
 
 
+def _load_session(token):
+    """Returns the stored session and its expire date for the given token"""
+    if is_signed_token(token):
+        return load_signed_session(token)
+
+    if _session_cache is not None:
+        cached = _session_cache.get(token)
+        if cached is not None:
+            return cached
+
+    redis = _session_store()
+    session, ttl = redis.get_with_ttl(token)
+    if session is None:
+        return None, None
+    # The TTL in redis is authoritative, the stored date is only updated when
+    # the whole session is rewritten
+    if ttl >= 0:
+        expire_date = time.time() + ttl
+    else:
+        expire_date = session["expireDate"]
+    if _session_cache is not None:
+        _session_cache.put(token, session, expire_date)
+    return session, expire_date
+
+
+def parse_authorization(header):
+    """Returns the session token of an Authorization header value"""
+    if header is None:
+        raise NoAuthorizationHeaderError()
+    auth_header = header.split(" ")
+    if len(auth_header) == 2 and auth_header[0].upper() == "BEARER":
+        return auth_header[1]
+    raise InvalidAuthorizationHeader()
+
+
+def check_session(session, expire_date, client_ip, access_limit):
+    """Checks a stored session for a request and returns it as Session
+
+    Expired sessions raise SessionExpiredError and have to be destroyed by
+    the caller.
+    """
+    if session is None:
+        raise InvalidSessionError()
+    if expire_date <= time.time():
+        raise SessionExpiredError()
+    if session["clientIP"] != client_ip:
+        raise ClientOriginViolation()
+    if access_limit is not None and session["userRole"] not in access_limit:
+        raise AccessDeniedError()
+
+    session = Session(session, stored_expire_date=expire_date)
+    # Reset expiration date for session
+    session.touch()
+    return session
+
+
+def renew_signed_token(session):
+    """Returns a new token for a signed session which has to be extended
+
+    The token keeps the ID of the session, so a logout revokes all tokens
+    issued for it. None is returned if the current token is still fine.
+    """
+    if session["userRole"] == UserRole.APP or not session.needs_refresh():
+        return None
+    claims = {key: value for key, value in session.items() if key != "sessionToken"}
+    claims["expireDate"] = int(session["expireDate"])
+    return sign_token(claims)
+
+
+@metrics.timed("authenticate")
 def authenticate(access_limit):
     """Authenticates an incoming requests and loads session information"""
     if request.endpoint in _public_paths:
         return
     elif request.method == "OPTIONS":
         return
-    else:
-        if "Authorization" in request.headers:
-            auth_header = request.headers["Authorization"].split(" ")
-            if len(auth_header) == 2 and auth_header[0].upper() == "BEARER":
-                token = auth_header[1]
-                redis = RedisAdapter("sessions")
-                session = redis.get(token)
-                if session is not None:
-                    if session["expireDate"] > time.time():
-                        if session["clientIP"] == _get_request_ip():
-                            if access_limit is not None:
-                                if session["userRole"] not in access_limit:
-                                    raise AccessDeniedError()
-                            # Reset expiration date for session
-                            session["expireDate"] = time.time() + (60 * 30)
-                            g.session = session
-                        else:
-                            raise ClientOriginViolation()
-                    else:
-                        destroy_session(token)
-                        raise SessionExpiredError()
-                else:
-                    raise InvalidSessionError()
-            else:
-                raise InvalidAuthorizationHeader()
-        else:
-            raise NoAuthorizationHeaderError()
+
+    token = parse_authorization(request.headers.get("Authorization"))
+    session, expire_date = _load_session(token)
+    try:
+        g.session = check_session(session, expire_date, _get_request_ip(), access_limit)
+    except SessionExpiredError:
+        destroy_session(token)
+        raise
 
 
-def save_session():
+def save_session(response):
     """Saves the current session state"""
-    if (
+    if "session" in g and g.session is not None and "tokenID" in g.session:
+        # Signed sessions are not stored, their clients get a renewed token
+        token = renew_signed_token(g.session)
+        if token is not None:
+            response.headers[SESSION_TOKEN_HEADER] = token
+    elif (
         "session" in g
         and g.session is not None
         and g.session["userRole"] != UserRole.APP
     ):
         token = g.session["sessionToken"]
-        redis = RedisAdapter("sessions")
-        redis.set(token, g.session)
+        expire_date = g.session["expireDate"]
+        if g.session.modified:
+            redis = _session_store()
+            redis.set(token, dict(g.session), expire_at=int(expire_date))
+            if _session_cache is not None:
+                _session_cache.invalidate(token)
+        elif g.session.needs_refresh():
+            # Nothing changed, only the sliding expiration has to move
+            redis = _session_store()
+            if redis.hash_values:
+                redis.update(
+                    token, {"expireDate": expire_date}, expire_at=int(expire_date)
+                )
+            else:
+                redis.expire(token, int(expire_date))
+            if _session_cache is not None:
+                _session_cache.refresh(str(token), expire_date)
 
 
 def noauth(fn):
@@ -102,13 +353,9 @@ def noauth(fn):
 def restrict_to(*roles):
     """Decorator to restrict access to certain user roles"""
 
-    def decorator(f):
-        @wraps(f)
-        def wrapper(*args, **kw):
-            f.access_limit = roles
-            return f(*args, **kw)
-
-        return wrapper
+    def decorator(fn):
+        fn.access_limit = roles
+        return fn
 
     return decorator
 
@@ -161,3 +408,12 @@ class InvalidAuthorizationHeader(APIException):
             error_code=1106,
             message="The authorization header is invalid",
         )
+
+
+class SessionsUnavailableError(APIException):
+    def __init__(self):
+        super(SessionsUnavailableError, self).__init__(
+            status_code=503,
+            error_code=1107,
+            message="Sessions cannot be checked right now, please try again later",
+        )
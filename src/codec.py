@@ -0,0 +1,176 @@
+""" Value codecs
+
+Codecs convert the values stored by RedisAdapter into bytes and back. Every
+format written by a codec starts with a version byte, values written with
+pickle (which always starts with the PROTO opcode 0x80) remain readable.
+"""
+
+import pickle
+import struct
+import uuid
+
+from bson import ObjectId
+
+PICKLE_PROTO = 0x80
+
+
+class CodecError(ValueError):
+    pass
+
+
+class PickleCodec(object):
+    """Stores arbitrary python values using pickle"""
+
+    def dumps(self, value):
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, raw):
+        return pickle.loads(raw)
+
+
+class SessionCodec(object):
+    """Compact fixed field encoding for session dictionaries
+
+    Layout of version 1 (network byte order):
+
+        version    B    format version
+        flags      B    FLAG_OBJECTID if userID is an ObjectId
+        expireDate d
+        userID     12s  ObjectId bytes, unused otherwise
+        token      16s  sessionToken UUID bytes
+        role_len   B
+        ip_len     B
+        id_len     B    length of a string userID
+        role, ip and a string userID follow as UTF-8
+
+    Sessions that do not match this layout are stored with pickle.
+
+    For hash storage every field is encoded on its own as a type tag followed
+    by the value, the format version is kept in the "_v" field.
+    """
+
+    VERSION = 1
+    FIELDS = frozenset(("userID", "userRole", "clientIP", "expireDate", "sessionToken"))
+    FLAG_OBJECTID = 0x01
+
+    _header = struct.Struct("!BBd12s16sBBB")
+    _double = struct.Struct("!d")
+    _version_field = b"_v"
+
+    def __init__(self):
+        self._fallback = PickleCodec()
+
+    def dumps(self, session):
+        if session.keys() != self.FIELDS:
+            return self._fallback.dumps(session)
+
+        token = session["sessionToken"]
+        if not isinstance(token, uuid.UUID):
+            try:
+                token = uuid.UUID(str(token))
+            except ValueError:
+                return self._fallback.dumps(session)
+
+        user_id = session["userID"]
+        if isinstance(user_id, ObjectId):
+            flags = self.FLAG_OBJECTID
+            oid = user_id.binary
+            user_id = b""
+        else:
+            flags = 0
+            oid = b""
+            user_id = str(user_id).encode("utf-8")
+        role = session["userRole"].encode("utf-8")
+        ip = session["clientIP"].encode("utf-8")
+        if max(len(user_id), len(role), len(ip)) > 0xFF:
+            return self._fallback.dumps(session)
+
+        return (
+            self._header.pack(
+                self.VERSION,
+                flags,
+                session["expireDate"],
+                oid,
+                token.bytes,
+                len(role),
+                len(ip),
+                len(user_id),
+            )
+            + role
+            + ip
+            + user_id
+        )
+
+    def loads(self, raw):
+        version = raw[0]
+        if version == PICKLE_PROTO:
+            return self._fallback.loads(raw)
+        if version != self.VERSION:
+            raise CodecError("Unknown session format version %d" % version)
+
+        (
+            _,
+            flags,
+            expire_date,
+            oid,
+            token,
+            role_len,
+            ip_len,
+            id_len,
+        ) = self._header.unpack_from(raw)
+        offset = self._header.size
+        role = raw[offset : offset + role_len].decode("utf-8")
+        offset += role_len
+        ip = raw[offset : offset + ip_len].decode("utf-8")
+        offset += ip_len
+        if flags & self.FLAG_OBJECTID:
+            user_id = ObjectId(oid)
+        else:
+            user_id = raw[offset : offset + id_len].decode("utf-8")
+
+        return {
+            "userID": user_id,
+            "userRole": role,
+            "clientIP": ip,
+            "expireDate": expire_date,
+            "sessionToken": uuid.UUID(bytes=token),
+        }
+
+    def dumps_fields(self, session):
+        fields = {self._version_field: b"%d" % self.VERSION}
+        for name, value in session.items():
+            if isinstance(value, str):
+                raw = b"s" + value.encode("utf-8")
+            elif isinstance(value, float):
+                raw = b"d" + self._double.pack(value)
+            elif isinstance(value, ObjectId):
+                raw = b"o" + value.binary
+            elif isinstance(value, uuid.UUID):
+                raw = b"u" + value.bytes
+            else:
+                raw = b"p" + self._fallback.dumps(value)
+            fields[name.encode("utf-8")] = raw
+        return fields
+
+    def loads_fields(self, fields):
+        version = fields.pop(self._version_field, None)
+        if version != b"%d" % self.VERSION:
+            raise CodecError("Unknown session format version %r" % version)
+
+        session = {}
+        for name, raw in fields.items():
+            tag, raw = raw[:1], raw[1:]
+            if tag == b"s":
+                value = raw.decode("utf-8")
+            elif tag == b"d":
+                value = self._double.unpack(raw)[0]
+            elif tag == b"o":
+                value = ObjectId(raw)
+            elif tag == b"u":
+                value = uuid.UUID(bytes=raw)
+            elif tag == b"p":
+                value = self._fallback.loads(raw)
+            else:
+                raise CodecError("Unknown field type %r" % tag)
+            session[name.decode("utf-8")] = value
+        return session
@@ -7,3 +7,113 @@ ENVIRONMENT = os.environ.get("ENVIRONMENT", "dev")
 REDIS = "redis:6379"
 MONGO_ADDRESS = "mongodb://mongo:27017/"
 MONGO = MONGO_ADDRESS + "bluquist_" + ENVIRONMENT
+# Build missing indexes declared on the models when the app is imported, only
+# meant for local development. Deployments run indexes.py once before the
+# workers start, see prestart.sh.
+MONGO_SYNC_INDEXES = False
+
+# Where team members are stored, either "embedded" in the team document or
+# in the separate "collection" of TeamMembership documents. Existing members
+# are moved with migrate_memberships.py.
+TEAM_MEMBERSHIP_STORAGE = "embedded"
+
+# Redis connection pool, shared by all adapters of a worker process
+REDIS_MAX_CONNECTIONS = 16
+# Seconds to wait for a free pooled connection before failing
+REDIS_POOL_TIMEOUT = 5
+REDIS_SOCKET_TIMEOUT = 2
+REDIS_CONNECT_TIMEOUT = 2
+
+# Sessions expire after 30 minutes of inactivity
+SESSION_LIFETIME = 60 * 30
+# Unmodified sessions only get their expiration date extended in redis when
+# it moves by at least this many seconds
+SESSION_REFRESH_INTERVAL = 60
+
+# Session tokens, either "opaque" (random IDs of the sessions in redis) or
+# "signed" (the session itself, signed with SESSION_TOKEN_SECRET and checked
+# without redis). Signed sessions expire after SESSION_TOKEN_LIFETIME seconds
+# of inactivity: once their expiration date moves by SESSION_REFRESH_INTERVAL,
+# responses carry a renewed token in the X-Session-Token header, which clients
+# have to send from then on. Tokens revoked by a logout are fetched by every
+# worker each SESSION_REVOCATION_SYNC_INTERVAL seconds, signed tokens are
+# rejected while a worker could not fetch them for SESSION_REVOCATION_MAX_AGE.
+SESSION_TOKEN_MODE = "opaque"
+SESSION_TOKEN_SECRET = os.environ.get("SESSION_TOKEN_SECRET", "")
+SESSION_TOKEN_LIFETIME = SESSION_LIFETIME
+SESSION_REVOCATION_SYNC_INTERVAL = 5
+SESSION_REVOCATION_MAX_AGE = 30
+
+# Optional per process cache of validated sessions
+SESSION_CACHE_ENABLED = False
+SESSION_CACHE_SIZE = 10000
+# Seconds a cached session may be served without asking redis
+SESSION_CACHE_TTL = 5
+
+# Session storage layout in redis, either "hash" (one hash field per session
+# attribute) or "string" (one encoded value per session)
+SESSION_STORE = "hash"
+
+# Validate payloads with code generated by fastjsonschema, if installed
+SCHEMA_FAST_PATH = False
+
+# Password hashing, either "pbkdf2_sha256" or "scrypt". Existing hashes are
+# upgraded to the current settings on the next successful login.
+PASSWORD_HASH_ALGORITHM = "pbkdf2_sha256"
+PASSWORD_PBKDF2_ITERATIONS = 260000
+PASSWORD_SCRYPT_N = 2**14
+PASSWORD_SCRYPT_R = 8
+PASSWORD_SCRYPT_P = 1
+# Concurrent hash computations per process and how many may wait for one.
+# Together they stay below the threads= of uwsgi.ini, which keeps request
+# threads free for everything but logins and registrations.
+PASSWORD_HASH_WORKERS = 2
+PASSWORD_HASH_QUEUE_SIZE = 2
+# Seconds to wait for a hashing slot before rejecting the request
+PASSWORD_HASH_QUEUE_TIMEOUT = 1
+
+# Requests per client IP and per mail address to the login and registration
+# routes, as (requests, seconds) sliding windows, see ratelimit.py. Client IPs
+# are taken from behind our trusted proxies. The login limit per mail counts
+# attempts from all addresses and is set well above what the owner of an
+# account needs, so others cannot easily lock them out. Each process
+# remembers up to RATE_LIMIT_BLOCKLIST_SIZE clients over a limit.
+RATE_LIMIT_ENABLED = True
+RATE_LIMIT_LOGIN_IP = (30, 60)
+RATE_LIMIT_LOGIN_MAIL = (60, 900)
+RATE_LIMIT_REGISTER_IP = (10, 3600)
+RATE_LIMIT_REGISTER_MAIL = (3, 3600)
+RATE_LIMIT_BLOCKLIST_SIZE = 10000
+
+# Team listing: documents fetched per cursor batch and the maximum page size
+TEAM_LIST_BATCH_SIZE = 100
+TEAM_LIST_MAX_LIMIT = 500
+
+# Profile changes are copied into the teams of a user by profile_sync.py,
+# which logs a warning once updates wait longer than this many seconds
+PROFILE_SYNC_BATCH_SIZE = 100
+PROFILE_SYNC_MAX_LAG = 60
+
+# Encoded team payloads cached per process, see serializer.py
+TEAM_CACHE_SIZE = 1000
+# Access of users to recently checked teams, cached in redis per team and
+# user until it changes or for at most TEAM_ACCESS_CACHE_TTL seconds, see
+# controller/team.py
+TEAM_ACCESS_CACHE_ENABLED = True
+TEAM_ACCESS_CACHE_TTL = 60 * 60
+# Attempts of conditional team updates before giving up with a conflict
+TEAM_UPDATE_RETRIES = 5
+
+# Latency histograms per component and endpoint, see metrics.py. Workers
+# add their counts to the shared totals every METRICS_FLUSH_INTERVAL seconds.
+# Only clients within METRICS_ALLOWED_NETWORKS (CIDR notation, addresses as
+# seen behind our trusted proxies) may fetch them from /static/metrics.
+METRICS_ENABLED = True
+METRICS_FLUSH_INTERVAL = 10
+METRICS_ALLOWED_NETWORKS = ("127.0.0.1/32", "::1/128")
+
+# ASGI serving, see asgi.py. Requests without a native async route run the
+# Flask app on a pool of this many threads.
+ASGI_NATIVE_ROUTES = True
+ASGI_WSGI_THREADS = 16
+ASGI_REDIS_MAX_CONNECTIONS = 256
@@ -1,26 +1,387 @@
-from model.Team import Team
+from bson import ObjectId
+from mongoengine.errors import ValidationError
+from pymongo.errors import BulkWriteError
+import config
+import serializer
+from RedisAdapter import RedisAdapter
+from model.Team import Team, TeamMember, TeamMembership
 
+# Member fields as returned to clients
+MEMBER_PROJECTION = {"_id": False, "team_id": False, "role_version": False}
 
-def get_teams_for_user(user_id):
-    return Team.objects(members__user_id=user_id)
+# Access of users to teams cached in redis, one value per team and user with
+# the access flags of the user: ADMIN if in the admin list and MEMBER if a
+# member, empty without access
+ACCESS_DATABASE = "team_access"
+ADMIN = "a"
+MEMBER = "m"
+
+# Duplicate key errors for memberships which have been added concurrently
+DUPLICATE_KEY = 11000
+
+
+def _separate_memberships():
+    return config.TEAM_MEMBERSHIP_STORAGE == "collection"
+
+
+def access_key(team_id, user_id):
+    return "%s\t%s" % (team_id, user_id)
+
+
+def _changed(team_id, bump_version=False, user_ids=()):
+    """Drops cached payloads of a modified team and the access of changed users
+
+    Updates of team documents increment the version themselves, membership
+    documents have to bump it separately. user_ids are the users who were
+    added, removed or changed their role.
+    """
+    if user_ids and config.TEAM_ACCESS_CACHE_ENABLED:
+        # Before the version changes, so anyone seeing the new version
+        # also sees the new access
+        RedisAdapter(ACCESS_DATABASE).invalidate_cache(
+            [access_key(team_id, user_id) for user_id in user_ids],
+            config.TEAM_ACCESS_CACHE_TTL,
+        )
+    if bump_version:
+        Team.objects(id=team_id).update_one(inc__version=1)
+    serializer.team_cache.invalidate(team_id)
+
+
+def _load_access(team_id, user_id):
+    """Returns the access flags of a user to a team"""
+    t = Team._get_collection().find_one(
+        {"_id": ObjectId(team_id)},
+        {"admin": True, "members": {"$elemMatch": {"user_id": user_id}}},
+    )
+    if t is None:
+        return ""
+    if _separate_memberships():
+        is_member = (
+            TeamMembership._get_collection().find_one(
+                {"team_id": ObjectId(team_id), "user_id": user_id}, {"_id": True}
+            )
+            is not None
+        )
+    else:
+        is_member = bool(t.get("members"))
+
+    access = MEMBER if is_member else ""
+    if user_id in t.get("admin", []):
+        access += ADMIN
+    return access
+
+
+def get_access(team_id, user_id):
+    """Returns the access flags of a user to a team, loaded into the cache once"""
+    if not ObjectId.is_valid(team_id):
+        raise ValidationError("Invalid team ID")
+    cache = RedisAdapter(ACCESS_DATABASE)
+    key = access_key(team_id, user_id)
+    access, generation = cache.get_cached(key)
+    if access is not None:
+        return access.decode("utf-8")
+
+    access = _load_access(team_id, user_id)
+    cache.fill_cache(key, access, generation, config.TEAM_ACCESS_CACHE_TTL)
+    return access
+
+
+def _iter_members(team_id):
+    return (
+        TeamMembership._get_collection()
+        .find({"team_id": ObjectId(team_id)}, MEMBER_PROJECTION)
+        .sort("_id", 1)
+        .batch_size(config.TEAM_LIST_BATCH_SIZE)
+    )
+
+
+def iter_teams_for_user(user_id, after=None, limit=None, members=True):
+    """Returns an iterator over the raw team documents of a user, ordered by ID
+
+    Only teams with an ID greater than after are returned. Without members,
+    the member lists are not loaded at all.
+    """
+    if _separate_memberships():
+        return _iter_teams_from_memberships(user_id, after, limit, members)
+
+    query = {"members.user_id": user_id}
+    if after is not None:
+        query["_id"] = {"$gt": ObjectId(after)}
+    projection = None if members else {"members": False}
+
+    cursor = Team._get_collection().find(query, projection)
+    cursor = cursor.sort("_id", 1).batch_size(config.TEAM_LIST_BATCH_SIZE)
+    if limit is not None:
+        cursor = cursor.limit(limit)
+    return cursor
+
+
+def _iter_teams_from_memberships(user_id, after, limit, members):
+    query = {"user_id": user_id}
+    if after is not None:
+        query["team_id"] = {"$gt": ObjectId(after)}
+
+    cursor = TeamMembership._get_collection().find(
+        query, {"_id": False, "team_id": True}
+    )
+    cursor = cursor.sort("team_id", 1).batch_size(config.TEAM_LIST_BATCH_SIZE)
+    if limit is not None:
+        cursor = cursor.limit(limit)
+
+    # Teams are loaded in batches of the membership cursor
+    team_ids = []
+    for membership in cursor:
+        team_ids.append(membership["team_id"])
+        if len(team_ids) == config.TEAM_LIST_BATCH_SIZE:
+            yield from _load_teams(team_ids, members)
+            team_ids = []
+    yield from _load_teams(team_ids, members)
+
+
+def _load_teams(team_ids, members):
+    if not team_ids:
+        return
+    teams = {
+        t["_id"]: t
+        for t in Team._get_collection().find(
+            {"_id": {"$in": team_ids}}, {"members": False}
+        )
+    }
+    for team_id in team_ids:
+        t = teams.get(team_id)
+        # The team may have been deleted in the meantime
+        if t is not None:
+            if members:
+                t["members"] = list(_iter_members(team_id))
+            yield t
 
 
 def get_team_with_id(id):
     return Team.objects.get(id=id)
 
 
-def remove_user_from_team(team_id, user_id):
-    Team.objects(id=team_id, members__user_id=user_id).update(
-        pull__members__user_id=user_id
+def get_team_for_user(team_id, user_id=None, admin=False, fields=()):
+    """Loads a team if the given user is a member (or admin) of it
+
+    The access check is part of the query or answered by the access cache.
+    None is returned if the team does not exist or the user has no access,
+    without user ID every team is accessible. If fields are given, only
+    those are loaded.
+    """
+    query = Team.objects(id=team_id)
+    if user_id is not None and config.TEAM_ACCESS_CACHE_ENABLED:
+        if (ADMIN if admin else MEMBER) not in get_access(team_id, user_id):
+            return None
+        if fields == ("id",):
+            # Nothing left to load, deleting a team drops the cached access
+            # of its members and admins
+            return Team(id=ObjectId(team_id))
+    elif user_id is not None:
+        if admin:
+            query = query.filter(admin=user_id)
+        elif _separate_memberships():
+            if not is_user_team_member(team_id, user_id):
+                return None
+        else:
+            query = query.filter(members__user_id=user_id)
+    if fields:
+        query = query.only(*fields)
+    t = query.first()
+
+    if (
+        t is not None
+        and _separate_memberships()
+        and (not fields or any(f.startswith("members") for f in fields))
+    ):
+        t.members = [TeamMember(**m) for m in _iter_members(t.id)]
+    return t
+
+
+def get_team_version_for_user(team_id, user_id=None):
+    """Returns the version of a team if the given user is a member of it
+
+    None is returned if the team does not exist or the user has no access.
+    Without user ID every team is accessible.
+    """
+    query = {"_id": ObjectId(team_id)}
+    if user_id is not None and config.TEAM_ACCESS_CACHE_ENABLED:
+        if MEMBER not in get_access(team_id, user_id):
+            return None
+    elif user_id is not None:
+        if _separate_memberships():
+            if not is_user_team_member(team_id, user_id):
+                return None
+        else:
+            query["members.user_id"] = user_id
+    t = Team._get_collection().find_one(query, {"version": True})
+    return None if t is None else t.get("version", 0)
+
+
+def get_raw_team(team_id):
+    """Loads a team as raw document including its members"""
+    t = Team._get_collection().find_one({"_id": ObjectId(team_id)})
+    if t is not None and _separate_memberships():
+        t["members"] = list(_iter_members(team_id))
+    return t
+
+
+def team_exists(team_id):
+    return Team.objects(id=team_id).only("id").first() is not None
+
+
+def create_team(name, admin):
+    """Creates a new team with the given TeamMember as its admin"""
+    t = Team()
+    t.name = name
+    t.admin = [admin.user_id]
+    if _separate_memberships():
+        t.save()
+        add_members_to_team(t.id, [admin])
+    else:
+        t.members = [admin]
+        t.save()
+    return t
+
+
+def rename_team(team_id, name):
+    Team.objects(id=team_id).update_one(set__name=name, inc__version=1)
+    _changed(team_id)
+
+
+def delete_team(team_id):
+    # The deleted document tells whose cached access has to go
+    t = Team._get_collection().find_one_and_delete(
+        {"_id": ObjectId(team_id)}, {"admin": True, "members.user_id": True}
     )
+    user_ids = set(t.get("admin", [])) if t is not None else set()
+    if _separate_memberships():
+        memberships = TeamMembership._get_collection()
+        user_ids.update(memberships.distinct("user_id", {"team_id": ObjectId(team_id)}))
+        memberships.delete_many({"team_id": ObjectId(team_id)})
+    elif t is not None:
+        user_ids.update(m["user_id"] for m in t.get("members", []))
+    _changed(team_id, user_ids=user_ids)
+
+
+def remove_user_from_team(team_id, user_id):
+    if _separate_memberships():
+        TeamMembership.objects(team_id=team_id, user_id=user_id).delete()
+        _changed(team_id, bump_version=True, user_ids=[user_id])
+    else:
+        Team.objects(id=team_id, members__user_id=user_id).update(
+            pull__members__user_id=user_id, inc__version=1
+        )
+        _changed(team_id, user_ids=[user_id])
 
 
 def is_user_team_member(team_id, user_id):
-    member = Team.objects(id=team_id, members__user_id=user_id).first()
+    if config.TEAM_ACCESS_CACHE_ENABLED:
+        return MEMBER in get_access(team_id, user_id)
+    if _separate_memberships():
+        member = (
+            TeamMembership.objects(team_id=team_id, user_id=user_id).only("id").first()
+        )
+    else:
+        member = Team.objects(id=team_id, members__user_id=user_id).first()
     return member is not None
 
 
-def update_user_role(team_id, user_id, role):
-    Team.objects(id=team_id, members__user_id=user_id).update_one(
-        set__members__S__role=role
-    )
+def _at_version(team_id, version):
+    """Query matching a team only as long as it has the given version"""
+    if version == 0:
+        # Teams created before versioning have no version field
+        return Team.objects(id=team_id, version__in=[0, None])
+    return Team.objects(id=team_id, version=version)
+
+
+def change_member_role(team_id, user_id, role, version):
+    """Sets the role of a member if the team still has the given version
+
+    The role and the admin list of the team are changed together. Returns
+    False without changing anything if the team has been modified since.
+    """
+    if role == "admin":
+        admin_update = {"add_to_set__admin": user_id}
+    else:
+        admin_update = {"pull__admin": user_id}
+
+    query = _at_version(team_id, version)
+    if _separate_memberships():
+        if not query.update_one(inc__version=1, **admin_update):
+            return False
+        # Concurrent role changes may reach the membership in any order, the
+        # one with the latest team version wins
+        TeamMembership.objects(
+            team_id=team_id, user_id=user_id, role_version__not__gte=version + 1
+        ).update_one(set__role=role, set__role_version=version + 1)
+        _changed(team_id, bump_version=True, user_ids=[user_id])
+    else:
+        if not query.filter(members__user_id=user_id).update_one(
+            set__members__S__role=role, inc__version=1, **admin_update
+        ):
+            return False
+        _changed(team_id, user_ids=[user_id])
+    return True
+
+
+def get_team_member_ids(team_id, user_ids):
+    """Returns the subset of the given user IDs which are members of a team"""
+    if _separate_memberships():
+        return set(
+            TeamMembership.objects(team_id=team_id, user_id__in=user_ids).distinct(
+                "user_id"
+            )
+        )
+    t = Team.objects(id=team_id).only("members.user_id").first()
+    if t is None:
+        return set()
+    return {m.user_id for m in t.members}.intersection(user_ids)
+
+
+def add_members_to_team(team_id, members):
+    """Adds TeamMembers to a team and returns the user IDs actually added
+
+    Members which have been added concurrently are skipped. For embedded
+    members the update is atomic, nothing is written if any of them exists.
+    """
+    user_ids = [m.user_id for m in members]
+    if _separate_memberships():
+        docs = []
+        for m in members:
+            doc = m.to_mongo().to_dict()
+            doc["team_id"] = ObjectId(team_id)
+            docs.append(doc)
+        try:
+            TeamMembership._get_collection().insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details["writeErrors"]
+            if any(err["code"] != DUPLICATE_KEY for err in errors):
+                raise
+            failed = {docs[err["index"]]["user_id"] for err in errors}
+            user_ids = [i for i in user_ids if i not in failed]
+        if user_ids:
+            _changed(team_id, bump_version=True, user_ids=user_ids)
+        return user_ids
+
+    if Team.objects(id=team_id, members__user_id__nin=user_ids).update_one(
+        push_all__members=members, inc__version=1
+    ):
+        _changed(team_id, user_ids=user_ids)
+        return user_ids
+    return []
+
+
+def remove_users_from_team(team_id, user_ids):
+    if not user_ids:
+        return
+    if _separate_memberships():
+        TeamMembership.objects(team_id=team_id, user_id__in=list(user_ids)).delete()
+        _changed(team_id, bump_version=True, user_ids=user_ids)
+    else:
+        Team.objects(id=team_id).update_one(
+            __raw__={
+                "$pull": {"members": {"user_id": {"$in": list(user_ids)}}},
+                "$inc": {"version": 1},
+            }
+        )
+        _changed(team_id, user_ids=user_ids)
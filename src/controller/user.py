@@ -7,3 +7,7 @@ def get_user_by_id(id):
 
 def get_user_by_mail(mail):
     return User.objects.get(mail=mail)
+
+
+def get_users_by_ids(ids):
+    return User.objects(id__in=ids)
@@ -3,8 +3,13 @@
 This module defines various exceptions that can occur during execution.
 """
 
+import inspect
+
 import util
 
+# Encoded bodies of the errors raised with a fixed message, by class
+_fixed_bodies = {}
+
 
 class APIException(Exception):
     def __init__(self, message=None, status_code=500, error_code=1000):
@@ -13,14 +18,37 @@ class APIException(Exception):
         self.status_code = status_code
         self.error_code = error_code
 
+    def encode(self):
+        """Returns the encoded response body of the error"""
+        body = _fixed_bodies.get(type(self))
+        if body is None:
+            body = util.encode_body(
+                error_code=self.error_code, error_message=self.message
+            )
+        return body
+
     def getResponse(self):
         return util.response(
             status_code=self.status_code,
             error_code=self.error_code,
-            error_message=self.message,
+            body=self.encode(),
         )
 
 
+def encode_fixed_bodies():
+    """Encodes the bodies of all errors defined so far with a fixed message
+
+    Errors taking no arguments always have the same message, all others are
+    encoded whenever they are raised.
+    """
+    classes = APIException.__subclasses__()
+    while classes:
+        cls = classes.pop()
+        classes.extend(cls.__subclasses__())
+        if list(inspect.signature(cls.__init__).parameters) == ["self"]:
+            _fixed_bodies[cls] = cls().encode()
+
+
 class NotFoundError(APIException):
     def __init__(self):
         super(NotFoundError, self).__init__(
@@ -69,3 +97,10 @@ class InvalidRequestHeader(APIException):
             error_code=1006,
             message="The request header contains invalid or contradicting fields or values.",
         )
+
+
+class NoSuchEndpointError(APIException):
+    def __init__(self):
+        super(NoSuchEndpointError, self).__init__(
+            status_code=404, error_code=1007, message="No such endpoint"
+        )
@@ -0,0 +1,70 @@
+""" Index management
+
+This module builds the indexes declared in the model meta data and verifies
+that the queries issued by the controllers are served by an index. Running
+it syncs the indexes of the configured database and checks the query plans.
+"""
+
+import sys
+
+from model.Team import Team, TeamMembership
+from model.User import User
+
+MODELS = (User, Team, TeamMembership)
+
+# Filters used by the controllers and routes, by model
+QUERIES = (
+    (User, {"mail": ""}),
+    (Team, {"name": ""}),
+    (Team, {"members.user_id": ""}),
+    (Team, {"admin": ""}),
+    (TeamMembership, {"team_id": None, "user_id": ""}),
+    (TeamMembership, {"user_id": ""}),
+)
+
+
+class MissingIndexError(Exception):
+    pass
+
+
+def sync_indexes():
+    """Creates all declared indexes, new indexes are built in the background"""
+    for model in MODELS:
+        model.ensure_indexes()
+
+
+def _plan_stages(plan):
+    yield plan["stage"]
+    for key in ("inputStage", "innerStage", "outerStage"):
+        if key in plan:
+            yield from _plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from _plan_stages(child)
+
+
+def check_query_plans():
+    """Raises MissingIndexError if one of the known queries scans a collection"""
+    unsupported = []
+    for model, query in QUERIES:
+        plan = model._get_collection().find(query).explain()
+        if "COLLSCAN" in _plan_stages(plan["queryPlanner"]["winningPlan"]):
+            unsupported.append("%s %s" % (model.__name__, sorted(query)))
+    if unsupported:
+        raise MissingIndexError(
+            "No supporting index for queries: " + ", ".join(unsupported)
+        )
+
+
+if __name__ == "__main__":
+    from main import app
+
+    with app.app_context():
+        print("Sync indexes")
+        sync_indexes()
+        print("Check query plans")
+        try:
+            check_query_plans()
+        except MissingIndexError as e:
+            print(e)
+            sys.exit(1)
+    print("All queries are supported by an index")
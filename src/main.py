@@ -2,13 +2,15 @@ from flask import Flask, request
 from flask_cors import CORS
 from database import db
 import config
+import metrics
 
 # Define API base route
 BASE_ROUTE = "/bluquist/v" + config.VERSION
 
 # Initialize flask app
 app = Flask(__name__)
-CORS(app)
+# Browsers may read the renewed tokens of signed sessions
+CORS(app, expose_headers=["X-Session-Token"])
 app.config["MONGODB_SETTINGS"] = {
     "db": "bluquist_" + config.ENVIRONMENT,
     "host": config.MONGO,
@@ -17,7 +19,11 @@ db.init_app(app)
 
 # Import modules after app initialization to avoid circular references
 from error import APIException, NotFoundError, MethodNotAllowedError
+from error import NoSuchEndpointError, encode_fixed_bodies
 import auth
+import indexes
+import policy
+import ratelimit
 import util
 import routes.static.route
 import routes.user.route
@@ -28,6 +34,19 @@ app.register_blueprint(routes.static.route.static, url_prefix=BASE_ROUTE + "/sta
 app.register_blueprint(routes.user.route.user, url_prefix=BASE_ROUTE + "/user")
 app.register_blueprint(routes.team.route.team, url_prefix=BASE_ROUTE + "/team")
 
+# Access rules of all routes, routes registered later are not served
+policies = policy.compile_policies(app)
+
+# All error classes are defined once the routes are imported
+encode_fixed_bodies()
+
+# Create missing database indexes, see indexes.py
+if config.MONGO_SYNC_INDEXES:
+    try:
+        indexes.sync_indexes()
+    except Exception:
+        app.logger.exception("Failed to sync the database indexes")
+
 
 # Global request handlers
 @app.errorhandler(APIException)
@@ -55,24 +74,29 @@ def handle_500(error):
     )
 
 
+if config.METRICS_ENABLED:
+    # Registered first, so the request time includes all other handlers
+    app.before_request(metrics.start_request)
+    app.after_request(metrics.end_request)
+
+
 @app.before_request
 def handle_authentication():
     """Handles authentication for every non-public API request"""
-    if request.endpoint is None:
-        return util.response(
-            status_code=404, error_code=1007, error_message="No such endpoint"
-        )
-    if not getattr(app.view_functions[request.endpoint], "is_public", False):
-        access_limit = getattr(
-            app.view_functions[request.endpoint], "access_limit", None
-        )
-        auth.authenticate(access_limit)
+    endpoint_policy = policies.get(request.endpoint)
+    if endpoint_policy is None:
+        return NoSuchEndpointError().getResponse()
+    # CORS preflights carry no credentials and must not use up the limits
+    if endpoint_policy.rate_limits is not None and request.method != "OPTIONS":
+        ratelimit.check(request.endpoint, endpoint_policy.rate_limits)
+    if not endpoint_policy.public:
+        auth.authenticate(endpoint_policy.roles)
 
 
 @app.after_request
 def save_session_state(r):
     """Saves the current session state after each request to the redis database"""
-    auth.save_session()
+    auth.save_session(r)
     return r
 
 
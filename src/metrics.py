@@ -0,0 +1,220 @@
+""" Latency metrics
+
+Wall time histograms of the hot path components (authentication, redis
+calls, payload validation, MongoDB commands, response building and the
+whole request), keyed by component and endpoint. Every worker process
+counts in memory and adds its counts to a redis hash in the background
+every METRICS_FLUSH_INTERVAL seconds, render() returns the totals of all
+workers in the Prometheus text format, together with the length and lag of
+the profile sync queue (see profile_sync.py).
+
+With METRICS_ENABLED unset, timed() leaves functions untouched and no
+listener or thread is installed.
+"""
+
+import os
+import time
+import logging
+import threading
+from bisect import bisect_left
+from functools import wraps
+
+from flask import request
+from pymongo import monitoring
+
+import config
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets in seconds, the last one is +Inf
+BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+HISTOGRAM = "bluquist_latency_seconds"
+QUEUE_LAG = "bluquist_profile_sync_lag_seconds"
+QUEUE_LENGTH = "bluquist_profile_sync_queue_length"
+COUNTERS_KEY = "latency"
+
+# Counts of this process since the last flush, by (component, endpoint):
+# one count per bucket followed by the sum of all observed durations
+_counts = {}
+_counts_lock = threading.Lock()
+_flusher_pid = None
+# Endpoint of the request handled by the current thread
+_current = threading.local()
+
+
+def observe(component, seconds):
+    """Records the duration of a component for the endpoint of the request"""
+    endpoint = getattr(_current, "endpoint", None)
+    if endpoint is None:
+        # Not handling a request
+        return
+    record(component, endpoint, seconds)
+
+
+def record(component, endpoint, seconds):
+    """Records the duration of a component for an endpoint"""
+    key = (component, endpoint)
+    with _counts_lock:
+        counts = _counts.get(key)
+        if counts is None:
+            counts = _counts[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        counts[bisect_left(BUCKETS, seconds)] += 1
+        counts[-1] += seconds
+    if _flusher_pid != os.getpid():
+        _start_flusher()
+
+
+def timed(component):
+    """Decorator to record the wall time of a function"""
+
+    def decorator(f):
+        if not config.METRICS_ENABLED:
+            return f
+
+        @wraps(f)
+        def wrapper(*args, **kw):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kw)
+            finally:
+                observe(component, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def start_request():
+    _current.endpoint = request.endpoint or "none"
+    _current.start = time.perf_counter()
+
+
+def end_request(r):
+    if getattr(_current, "endpoint", None) is not None:
+        observe("request", time.perf_counter() - _current.start)
+        _current.endpoint = None
+    return r
+
+
+class CommandTimer(monitoring.CommandListener):
+    """Records the duration of MongoDB commands, which run on the request thread"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        observe("mongo", event.duration_micros / 1e6)
+
+    def failed(self, event):
+        observe("mongo", event.duration_micros / 1e6)
+
+
+def _store():
+    # Imported here, RedisAdapter itself is instrumented
+    from RedisAdapter import RedisAdapter
+
+    return RedisAdapter("metrics")
+
+
+def flush():
+    """Adds the counts of this process to the totals of all workers"""
+    global _counts
+    with _counts_lock:
+        counts, _counts = _counts, {}
+    if not counts:
+        return
+
+    fields = {}
+    for (component, endpoint), values in counts.items():
+        prefix = component + "\t" + endpoint + "\t"
+        for i, count in enumerate(values[:-1]):
+            if count:
+                fields[prefix + str(i)] = count
+        fields[prefix + "sum"] = values[-1]
+    _store().add_to_counters(COUNTERS_KEY, fields)
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(config.METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception:
+            log.exception("Failed to flush latency metrics")
+
+
+def _start_flusher():
+    global _flusher_pid
+    with _counts_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    threading.Thread(
+        target=_flush_periodically, name="metrics-flush", daemon=True
+    ).start()
+
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def render():
+    """Returns the histograms of all workers in the Prometheus text format"""
+    flush()
+    histograms = {}
+    for field, value in _store().get_counters(COUNTERS_KEY).items():
+        component, endpoint, index = field.decode("utf-8").split("\t")
+        values = histograms.setdefault(
+            (component, endpoint), [0] * (len(BUCKETS) + 1) + [0.0]
+        )
+        if index == "sum":
+            values[-1] = float(value)
+        else:
+            values[int(index)] = int(float(value))
+
+    lines = [
+        "# HELP %s Wall time per component and endpoint" % HISTOGRAM,
+        "# TYPE %s histogram" % HISTOGRAM,
+    ]
+    for (component, endpoint), values in sorted(histograms.items()):
+        labels = 'component="%s",endpoint="%s"' % (_label(component), _label(endpoint))
+        total = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), values):
+            total += count
+            lines.append('%s_bucket{%s,le="%s"} %d' % (HISTOGRAM, labels, bound, total))
+        lines.append("%s_sum{%s} %r" % (HISTOGRAM, labels, values[-1]))
+        lines.append("%s_count{%s} %d" % (HISTOGRAM, labels, total))
+
+    # Imported here, profile_sync needs the models
+    import profile_sync
+
+    lines.extend(
+        [
+            "# HELP %s Seconds the oldest queued profile update has waited" % QUEUE_LAG,
+            "# TYPE %s gauge" % QUEUE_LAG,
+            "%s %r" % (QUEUE_LAG, profile_sync.lag()),
+            "# HELP %s Profile updates waiting to be applied" % QUEUE_LENGTH,
+            "# TYPE %s gauge" % QUEUE_LENGTH,
+            "%s %d" % (QUEUE_LENGTH, profile_sync.queue_length()),
+        ]
+    )
+    return "\n".join(lines) + "\n"
+
+
+if config.METRICS_ENABLED:
+    # Only clients created afterwards report their commands
+    monitoring.register(CommandTimer())
@@ -0,0 +1,69 @@
+""" Membership migration
+
+Running this module copies the members embedded in team documents into the
+TeamMembership collection, which is used with TEAM_MEMBERSHIP_STORAGE set to
+"collection". Members that have already been copied are skipped, so the
+migration can be repeated. With --drop-embedded the embedded member lists
+are removed afterwards.
+"""
+
+import argparse
+
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError
+
+import config
+from model.Team import Team, TeamMembership
+
+# Duplicate key errors for members that have been copied before
+DUPLICATE_KEY = 11000
+
+
+def migrate(batch_size=1000, drop_embedded=False):
+    """Copies all embedded members and returns the number of new memberships"""
+    teams = Team._get_collection()
+    memberships = TeamMembership._get_collection()
+    copied = 0
+    requests = []
+
+    def flush():
+        nonlocal copied
+        if not requests:
+            return
+        try:
+            copied += memberships.bulk_write(requests, ordered=False).inserted_count
+        except BulkWriteError as e:
+            if any(err["code"] != DUPLICATE_KEY for err in e.details["writeErrors"]):
+                raise
+            copied += e.details["nInserted"]
+        requests.clear()
+
+    cursor = teams.find({"members.0": {"$exists": True}}, {"members": True})
+    for t in cursor.batch_size(config.TEAM_LIST_BATCH_SIZE):
+        for m in t["members"]:
+            requests.append(InsertOne(dict(m, team_id=t["_id"])))
+            if len(requests) >= batch_size:
+                flush()
+    flush()
+
+    if drop_embedded:
+        teams.update_many({}, {"$set": {"members": []}})
+    return copied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument(
+        "--drop-embedded",
+        action="store_true",
+        help="remove the embedded member lists after copying them",
+    )
+    args = parser.parse_args()
+
+    from main import app
+
+    with app.app_context():
+        TeamMembership.ensure_indexes()
+        copied = migrate(args.batch_size, args.drop_embedded)
+    print("Copied %d memberships" % copied)
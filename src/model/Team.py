@@ -17,3 +17,45 @@ class Team(db.Document):
     name = db.StringField(required=True)
     admin = db.ListField(db.StringField(), default=list)
     members = db.ListField(db.EmbeddedDocumentField(TeamMember), default=list)
+    # Incremented by every modification, see controller/team.py
+    version = db.IntField(default=0)
+
+    meta = {
+        "indexes": [
+            {"fields": ["name"], "unique": True},
+            # Also serves the team listing of a user, which is ordered by ID
+            ("members.user_id", "id"),
+            "admin",
+        ],
+        # Indexes are built by indexes.sync_indexes()
+        "auto_create_index": False,
+        "index_background": True,
+    }
+
+
+class TeamMembership(db.Document):
+    """Stores a single team membership
+
+    Used instead of Team.members if config.TEAM_MEMBERSHIP_STORAGE is set to
+    "collection", which keeps team documents small for very large teams.
+    """
+
+    team_id = db.ObjectIdField(required=True)
+    user_id = db.StringField(required=True)
+    mail = db.StringField(required=True)
+    first_name = db.StringField()
+    last_name = db.StringField()
+    role = db.StringField()
+    # Team version the role was set at, see controller.team.change_member_role
+    role_version = db.IntField()
+
+    meta = {
+        "indexes": [
+            {"fields": ["team_id", "user_id"], "unique": True},
+            # Team listing of a user, ordered by team
+            ("user_id", "team_id"),
+        ],
+        # Indexes are built by indexes.sync_indexes()
+        "auto_create_index": False,
+        "index_background": True,
+    }
@@ -25,3 +25,10 @@ class User(db.Document):
 
     password_hash = db.StringField(required=True)
     password_salt = db.StringField(required=True)
+
+    meta = {
+        "indexes": [{"fields": ["mail"], "unique": True}],
+        # Indexes are built by indexes.sync_indexes()
+        "auto_create_index": False,
+        "index_background": True,
+    }
@@ -0,0 +1,126 @@
+""" Password hashing
+
+This module hashes and verifies user passwords. Hashes are stored as
+"<algorithm>$<parameters>$<digest>" next to their salt, so the algorithm and
+its cost can change without invalidating existing passwords. Hashes in the
+legacy format (a plain SHA-1 hex digest) are still accepted and should be
+replaced on the next successful login, see needs_rehash().
+
+Hashing is deliberately slow and runs on a small, bounded thread pool per
+process. uWSGI runs each process with several request threads (threads= in
+uwsgi.ini), so only some of them can be busy hashing and the rest keep
+serving other requests. Requests that cannot get a slot in time are rejected
+with a 503 instead of piling up behind a login storm.
+"""
+
+import os
+import hmac
+import hashlib
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from error import APIException
+
+PBKDF2_SHA256 = "pbkdf2_sha256"
+SCRYPT = "scrypt"
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_slots = None
+
+
+def _current_parameters():
+    if config.PASSWORD_HASH_ALGORITHM == PBKDF2_SHA256:
+        return str(config.PASSWORD_PBKDF2_ITERATIONS)
+    elif config.PASSWORD_HASH_ALGORITHM == SCRYPT:
+        return "%d,%d,%d" % (
+            config.PASSWORD_SCRYPT_N,
+            config.PASSWORD_SCRYPT_R,
+            config.PASSWORD_SCRYPT_P,
+        )
+    raise ValueError(
+        "Unknown password hash algorithm " + config.PASSWORD_HASH_ALGORITHM
+    )
+
+
+def _derive(algorithm, parameters, password, salt):
+    password = password.encode("utf-8")
+    salt = salt.encode("utf-8")
+    if algorithm == PBKDF2_SHA256:
+        return hashlib.pbkdf2_hmac("sha256", password, salt, int(parameters)).hex()
+    elif algorithm == SCRYPT:
+        n, r, p = (int(value) for value in parameters.split(","))
+        return hashlib.scrypt(
+            password, salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024
+        ).hex()
+    raise ValueError("Unknown password hash algorithm " + algorithm)
+
+
+def _legacy_hash(password, salt):
+    return str(hashlib.sha1((password + salt).encode("utf-8")).hexdigest())
+
+
+def _run(fn, *args):
+    """Runs fn on the hashing pool of this process and waits for the result"""
+    global _executor, _executor_pid, _slots
+    if _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(
+                    max_workers=config.PASSWORD_HASH_WORKERS,
+                    thread_name_prefix="password-hash",
+                )
+                _slots = threading.BoundedSemaphore(
+                    config.PASSWORD_HASH_WORKERS + config.PASSWORD_HASH_QUEUE_SIZE
+                )
+                _executor_pid = os.getpid()
+
+    if not _slots.acquire(timeout=config.PASSWORD_HASH_QUEUE_TIMEOUT):
+        raise PasswordHashingBusyError()
+    try:
+        return _executor.submit(fn, *args).result()
+    finally:
+        _slots.release()
+
+
+def hash_password(password):
+    """Returns the (password_hash, password_salt) pair for a new password"""
+    salt = secrets.token_hex(16)
+    algorithm = config.PASSWORD_HASH_ALGORITHM
+    parameters = _current_parameters()
+    digest = _run(_derive, algorithm, parameters, password, salt)
+    return "$".join((algorithm, parameters, digest)), salt
+
+
+def verify_password(password, password_hash, password_salt):
+    """Checks a password against a stored hash and salt"""
+    if "$" in password_hash:
+        algorithm, parameters, digest = password_hash.split("$", 2)
+        candidate = _run(_derive, algorithm, parameters, password, password_salt)
+    else:
+        digest = password_hash
+        candidate = _legacy_hash(password, password_salt)
+    return hmac.compare_digest(candidate, digest)
+
+
+def needs_rehash(password_hash):
+    """Checks whether a hash was created with outdated settings"""
+    if "$" not in password_hash:
+        return True
+    algorithm, parameters, _ = password_hash.split("$", 2)
+    return (
+        algorithm != config.PASSWORD_HASH_ALGORITHM
+        or parameters != _current_parameters()
+    )
+
+
+class PasswordHashingBusyError(APIException):
+    def __init__(self):
+        super(PasswordHashingBusyError, self).__init__(
+            status_code=503,
+            error_code=1008,
+            message="The service is busy, please try again later",
+        )
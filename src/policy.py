@@ -0,0 +1,57 @@
+""" Endpoint access policies
+
+The access rules the route decorators attach to view functions (noauth,
+restrict_to, verify_team_access and rate_limit) are collected once, after
+all blueprints are registered, into a read-only table by endpoint. The
+before request hook only needs a single lookup per request, and export()
+describes the rules of every route, e.g. to compare them with openapi.yaml.
+"""
+
+from collections import namedtuple
+from types import MappingProxyType
+
+# public: no session needed, roles: user roles allowed (None for all),
+# team_admin: only admins of the team in the payload, rate_limits: see
+# ratelimit.rate_limit()
+Policy = namedtuple("Policy", ("public", "roles", "team_admin", "rate_limits"))
+
+
+def policy_of(view):
+    """Returns the policy declared on a view function by its decorators"""
+    roles = getattr(view, "access_limit", None)
+    return Policy(
+        public=getattr(view, "is_public", False),
+        roles=tuple(roles) if roles is not None else None,
+        team_admin=getattr(view, "team_admin", False),
+        rate_limits=getattr(view, "rate_limits", None),
+    )
+
+
+def compile_policies(app):
+    """Returns the read-only table of policies by endpoint of an app"""
+    return MappingProxyType(
+        {endpoint: policy_of(view) for endpoint, view in app.view_functions.items()}
+    )
+
+
+def export(app, policies):
+    """Returns the policies of all routes as list of plain dicts"""
+    routes = []
+    for rule in sorted(app.url_map.iter_rules(), key=lambda r: r.rule):
+        policy = policies[rule.endpoint]
+        for method in sorted(rule.methods - {"HEAD", "OPTIONS"}):
+            routes.append(
+                {
+                    "path": rule.rule,
+                    "method": method,
+                    "endpoint": rule.endpoint,
+                    "public": policy.public,
+                    "roles": list(policy.roles) if policy.roles is not None else None,
+                    "teamAdmin": policy.team_admin,
+                    "rateLimits": [
+                        {"scope": scope, "requests": limit, "seconds": seconds}
+                        for scope, limit, seconds in policy.rate_limits or ()
+                    ],
+                }
+            )
+    return routes
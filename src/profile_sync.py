@@ -0,0 +1,154 @@
+""" Member profile synchronization
+
+Teams keep a copy of the name and mail of each member. Profile changes are
+queued with enqueue() and copied into all teams of the user by a worker,
+which is started by running this module. lag() returns how long the oldest
+queued change has been waiting, which bounds how outdated the member
+profiles of teams are. It is exported on the metrics endpoint together with
+queue_length().
+
+Workers move the updates they apply into a processing list of their own and
+only drop them once they are written, so updates of a worker that stops are
+re-queued when a worker with the same consumer name starts again. Applying
+an update twice is harmless.
+"""
+
+import time
+import socket
+import logging
+import argparse
+
+from pymongo import UpdateMany
+
+import config
+from RedisAdapter import RedisAdapter
+from model.Team import Team, TeamMembership
+
+log = logging.getLogger(__name__)
+
+QUEUE = "profiles"
+PROFILE_FIELDS = ("mail", "first_name", "last_name")
+
+
+def _queue():
+    return RedisAdapter("profile_sync")
+
+
+def _processing(consumer):
+    return QUEUE + "_processing_" + consumer
+
+
+def enqueue(user):
+    """Queues the profile of a user to be copied into their teams"""
+    update = {field: getattr(user, field) for field in PROFILE_FIELDS}
+    update["userID"] = str(user.id)
+    update["queuedAt"] = time.time()
+    _queue().push(QUEUE, update)
+
+
+def queue_length():
+    """Returns the number of queued updates not claimed by a worker yet"""
+    return _queue().length(QUEUE)
+
+
+def lag():
+    """Returns the seconds the oldest queued update has been waiting"""
+    update = _queue().peek(QUEUE)
+    if update is None:
+        return 0.0
+    return max(0.0, time.time() - update["queuedAt"])
+
+
+def apply_updates(updates):
+    """Copies queued profiles into the teams, only the latest one per user"""
+    latest = {}
+    for update in updates:
+        latest[update["userID"]] = update
+
+    teams = []
+    memberships = []
+    for user_id, update in latest.items():
+        profile = {field: update[field] for field in PROFILE_FIELDS}
+        teams.append(
+            UpdateMany(
+                {"members.user_id": user_id},
+                {
+                    "$set": {
+                        "members.$[elem]." + field: value
+                        for field, value in profile.items()
+                    },
+                    "$inc": {"version": 1},
+                },
+                array_filters=[{"elem.user_id": user_id}],
+            )
+        )
+        memberships.append(UpdateMany({"user_id": user_id}, {"$set": profile}))
+        if config.TEAM_MEMBERSHIP_STORAGE == "collection":
+            # Cached team payloads are only refreshed with a new version
+            team_ids = TeamMembership._get_collection().distinct(
+                "team_id", {"user_id": user_id}
+            )
+            teams.append(
+                UpdateMany({"_id": {"$in": team_ids}}, {"$inc": {"version": 1}})
+            )
+
+    if teams:
+        # Memberships are written first, so no team gets its new version
+        # before its members are updated
+        if config.TEAM_MEMBERSHIP_STORAGE == "collection":
+            TeamMembership._get_collection().bulk_write(memberships, ordered=False)
+        # Embedded members are updated in both modes, they are kept until
+        # migrate_memberships.py drops them
+        Team._get_collection().bulk_write(teams, ordered=False)
+
+
+def run(batch_size, consumer, timeout=5):
+    """Applies queued updates in batches until interrupted
+
+    The consumer name has to stay the same across restarts of a worker.
+    """
+    queue = _queue()
+    processing = _processing(consumer)
+    requeued = queue.requeue(processing, QUEUE)
+    if requeued:
+        log.warning("Re-queued %d profile updates of a previous run", requeued)
+
+    while True:
+        updates = queue.claim(QUEUE, processing, count=batch_size, timeout=timeout)
+        if not updates:
+            continue
+        apply_updates(updates)
+        queue.unset(processing)
+
+        delay = time.time() - min(u["queuedAt"] for u in updates)
+        if delay > config.PROFILE_SYNC_MAX_LAG:
+            log.warning("Profile updates applied %.1f seconds late", delay)
+        else:
+            log.info("Applied %d profile updates, lag %.1fs", len(updates), delay)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--batch-size", type=int, default=config.PROFILE_SYNC_BATCH_SIZE
+    )
+    parser.add_argument(
+        "--consumer",
+        default=socket.gethostname(),
+        help="name of this worker, updates it claimed are re-queued on restart",
+    )
+    parser.add_argument(
+        "--lag",
+        action="store_true",
+        help="print the age of the oldest queued update in seconds and exit",
+    )
+    args = parser.parse_args()
+
+    if args.lag:
+        print("%.3f" % lag())
+    else:
+        logging.basicConfig(level=logging.INFO)
+        from main import app
+
+        with app.app_context():
+            run(args.batch_size, args.consumer)
@@ -0,0 +1,124 @@
+""" Request rate limiting
+
+Routes decorated with rate_limit() accept a limited number of requests per
+client IP address and per mail address of the payload within a sliding
+window. The client IP address is the one our proxies received the request
+from, never a value of the client's own headers. The per mail limits stop
+attempts on one account from many addresses, so they are set high enough
+not to lock out its owner. The windows of all workers are kept in redis
+and checked and updated by a single script call. Clients over their limit are remembered by
+each process until their window has room again, so repeated attempts are
+rejected without asking redis.
+"""
+
+import math
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+from flask import request
+
+import config
+from error import APIException
+from RedisAdapter import RedisAdapter
+from util import get_peer_ip
+
+RATE_LIMIT_DATABASE = "ratelimit"
+
+# Keys over their limit in this process, mapped to the time they may retry
+_blocked = OrderedDict()
+_blocked_lock = threading.Lock()
+
+
+def _request_ip():
+    return get_peer_ip()
+
+
+def _request_mail():
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get("mail"), str):
+        # Left to the payload validation
+        return None
+    return payload["mail"].strip().lower()
+
+
+_scopes = {"ip": _request_ip, "mail": _request_mail}
+
+
+def rate_limit(ip=None, mail=None):
+    """Decorator to limit the requests to a single path
+
+    Limits are given as (requests, seconds) per client IP address and per
+    mail address of the JSON payload.
+    """
+
+    def decorator(fn):
+        if not config.RATE_LIMIT_ENABLED:
+            return fn
+        fn.rate_limits = tuple(
+            (scope, limit[0], limit[1])
+            for scope, limit in (("ip", ip), ("mail", mail))
+            if limit is not None
+        )
+        return fn
+
+    return decorator
+
+
+def _retry_after(keys, now):
+    """Returns the seconds until all keys are unblocked in this process"""
+    wait = 0
+    for key in keys:
+        until = _blocked.get(key)
+        if until is not None and until > now:
+            wait = max(wait, until - now)
+    return wait
+
+
+def _block(keys, now, waits):
+    with _blocked_lock:
+        for key, wait in zip(keys, waits):
+            if wait > 0:
+                _blocked[key] = max(now + wait, _blocked.get(key, 0))
+                _blocked.move_to_end(key)
+        while len(_blocked) > config.RATE_LIMIT_BLOCKLIST_SIZE:
+            _blocked.popitem(last=False)
+
+
+def check(endpoint, limits):
+    """Counts the current request, raises RateLimitExceededError if over a limit"""
+    windows = []
+    for scope, limit, seconds in limits:
+        value = _scopes[scope]()
+        if value is not None:
+            windows.append((endpoint + "\t" + scope + "\t" + value, limit, seconds))
+    if not windows:
+        return
+
+    now = time.time()
+    keys = [key for key, _, _ in windows]
+    wait = _retry_after(keys, now)
+    if wait > 0:
+        raise RateLimitExceededError(wait)
+
+    redis = RedisAdapter(RATE_LIMIT_DATABASE)
+    waits = redis.hit_windows(windows, now, uuid.uuid4().hex)
+    if waits:
+        _block(keys, now, waits)
+        raise RateLimitExceededError(max(waits))
+
+
+class RateLimitExceededError(APIException):
+    def __init__(self, retry_after):
+        super(RateLimitExceededError, self).__init__(
+            status_code=429,
+            error_code=1009,
+            message="Too many requests, please try again later",
+        )
+        self.retry_after = retry_after
+
+    def getResponse(self):
+        r = super(RateLimitExceededError, self).getResponse()
+        r.headers["Retry-After"] = str(max(1, math.ceil(self.retry_after)))
+        return r
@@ -3,14 +3,30 @@
 Blueprint defining static API routes.
 """
 
-from flask import Blueprint
-from util import response
+from flask import Blueprint, Response
+from util import response, get_peer_ip
 from auth import noauth
+from error import NotFoundError
 import config
+import ipaddress
+import metrics
 import time
 
 static = Blueprint("static", __name__)
 
+# Networks of the clients allowed to scrape the metrics, e.g. Prometheus
+_metrics_networks = [
+    ipaddress.ip_network(network) for network in config.METRICS_ALLOWED_NETWORKS
+]
+
+
+def _may_read_metrics(address):
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(address in network for network in _metrics_networks)
+
 
 @static.route("/info", methods=["GET"])
 def get_info():
@@ -26,3 +42,12 @@ def get_info():
 @noauth
 def ping_backend():
     return response(empty=True)
+
+
+@static.route("/metrics", methods=["GET"])
+@noauth
+def get_metrics():
+    # Not announced to anyone else
+    if not config.METRICS_ENABLED or not _may_read_metrics(get_peer_ip()):
+        raise NotFoundError()
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
@@ -1,33 +1,67 @@
 from flask import Blueprint, g, request
 from model.Team import Team, TeamMember
-from util import response, validate
+from util import encoded_response, response, stream_response, validate
 from controller import user as user_controller
 from controller import team as team_controller
-from error import APIException
+from error import APIException, BadParameterError
 from functools import wraps
+from bson import ObjectId
+from bson.errors import InvalidId
+import config
+import serializer
+from mongoengine.errors import NotUniqueError, ValidationError
 
 
 team = Blueprint("team", __name__)
 
 
-def verify_team_access(f):
-    # Verify the access to team data
-    @wraps(f)
-    def wrapper(*args, **kw):
-        try:
-            t = team_controller.get_team_with_id(g.payload["teamID"])
-        except Team.DoesNotExist:
-            raise TeamNotExistError()
-        # if the logged in user is super user with UserRole.Admin, it would be able to access all teams
-        # to avoid confussion, used UserRole.APP as super user role
-        if (
-            g.session["userRole"] != "appadmin"
-            and str(g.session["userID"]) not in t.admin
-        ):
-            raise AccessDeniedError()
-        return f(*args, **kw)
+def _restricted_user_id():
+    """Returns the ID of the logged in user or None if all teams are accessible"""
+    # if the logged in user is super user with UserRole.Admin, it would be able to access all teams
+    # to avoid confussion, used UserRole.APP as super user role
+    if g.session["userRole"] == "appadmin":
+        return None
+    return str(g.session["userID"])
+
+
+def _deny(team_id, user_id):
+    # Only failed requests need to tell missing teams and denied access apart
+    if user_id is not None and team_controller.team_exists(team_id):
+        raise AccessDeniedError()
+    raise TeamNotExistError()
+
+
+def _load_team(team_id, admin=False, fields=()):
+    """Loads a team the logged in user has access to with a single query"""
+    user_id = _restricted_user_id()
+    try:
+        t = team_controller.get_team_for_user(
+            team_id, user_id, admin=admin, fields=fields
+        )
+    except ValidationError:
+        raise TeamNotExistError()
+    if t is None:
+        _deny(team_id, user_id)
+    return t
+
+
+def verify_team_access(*fields):
+    """Decorator to verify admin access to the team of the request
+
+    The team is loaded once, restricted to the given fields, and stored in
+    g.team for the handler.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kw):
+            g.team = _load_team(g.payload["teamID"], admin=True, fields=fields)
+            return f(*args, **kw)
+
+        wrapper.team_admin = True
+        return wrapper
 
-    return wrapper
+    return decorator
 
 
 @team.route("/info", methods=["Get"])
@@ -36,23 +70,80 @@ def get_team_info():
 
     if team_id:
         # if there's particular team id, returns the corresponding team data
-        try:
-            t = team_controller.get_team_with_id(team_id)
-        except Team.DoesNotExist:
-            raise TeamNotExistError()
-        print(t.members[0]["user_id"])
-        print(str(g.session["userID"]))
-        if g.session["userRole"] != "appadmin" and not any(
-            member["user_id"] == str(g.session["userID"]) for member in t.members
-        ):
-            raise AccessDeniedError()
-
-        t = team_controller.get_team_with_id(team_id)
-        return response(payload=t)
+        return _team_info(team_id)
     else:
         # if there's no particular team id, returns the whole team data that the logged user is in
-        teams = team_controller.get_teams_for_user(str(g.session["userID"]))
-        return response(payload=teams)
+        return _list_teams()
+
+
+def _team_info(team_id):
+    """Responds with a team, encoded teams are cached by version"""
+    user_id = _restricted_user_id()
+    try:
+        version = team_controller.get_team_version_for_user(team_id, user_id)
+    except (InvalidId, ValidationError):
+        raise TeamNotExistError()
+    if version is None:
+        _deny(team_id, user_id)
+
+    payload = serializer.team_payload(
+        team_id, version, lambda: team_controller.get_raw_team(team_id)
+    )
+    if payload is None:
+        # Deleted in the meantime
+        raise TeamNotExistError()
+    return encoded_response(payload)
+
+
+def _list_teams():
+    """Streams the teams of the logged in user
+
+    Pages are requested with limit and continued with the "next" cursor of the
+    previous page passed as after. The members are left out with
+    fields=summary.
+    """
+    limit = request.args.get("limit")
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise BadParameterError("limit must be an integer")
+        if not 0 < limit <= config.TEAM_LIST_MAX_LIMIT:
+            raise BadParameterError(
+                "limit must be between 1 and %d" % config.TEAM_LIST_MAX_LIMIT
+            )
+
+    after = request.args.get("after")
+    if after is not None and not ObjectId.is_valid(after):
+        raise BadParameterError("after must be a team ID")
+
+    fields = request.args.get("fields", "full")
+    if fields not in ("full", "summary"):
+        raise BadParameterError("fields must be either full or summary")
+
+    cursor = team_controller.iter_teams_for_user(
+        str(g.session["userID"]),
+        after=after,
+        limit=limit,
+        members=fields == "full",
+    )
+
+    if limit is None:
+        return stream_response(cursor, serializer.encode_team)
+
+    page = {"count": 0, "last": None}
+
+    def teams():
+        for t in cursor:
+            page["count"] += 1
+            page["last"] = str(t["_id"])
+            yield t
+
+    def next_cursor():
+        # A short page is the last one
+        return page["last"] if page["count"] == limit else None
+
+    return stream_response(teams(), serializer.encode_team, next=next_cursor)
 
 
 @team.route("/register", methods=["POST"])
@@ -60,10 +151,6 @@ def get_team_info():
 def register_team():
     if _check_team_available(g.payload["name"]):
         # check if the team name is creatable
-        t = Team()
-        t.name = g.payload["name"]
-        t.admin = [str(g.session["userID"])]
-
         u = user_controller.get_user_by_id(id=g.session["userID"])
         m = TeamMember()
         m.user_id = str(g.session["userID"])
@@ -72,8 +159,11 @@ def register_team():
         m.mail = u.mail
         m.role = "admin"
 
-        t.members = [m]
-        t.save()
+        try:
+            team_controller.create_team(g.payload["name"], m)
+        except NotUniqueError:
+            # Registered concurrently
+            raise TeamNameInvalidError()
         return response(success=True)
     else:
         raise TeamNameInvalidError()
@@ -81,13 +171,14 @@ def register_team():
 
 @team.route("/rename", methods=["POST"])
 @validate("team_rename")
-@verify_team_access
+@verify_team_access("id")
 def rename_team():
     if _check_team_available(g.payload["name"]):
         # check if the team name is creatable
-        t = team_controller.get_team_with_id(g.payload["teamID"])
-        t.name = g.payload["name"]
-        t.save()
+        try:
+            team_controller.rename_team(g.team.id, g.payload["name"])
+        except NotUniqueError:
+            raise TeamNameInvalidError()
         return response(success=True)
     else:
         raise TeamNameInvalidError()
@@ -95,18 +186,17 @@ def rename_team():
 
 @team.route("/delete", methods=["DELETE"])
 @validate("team_delete")
-@verify_team_access
+@verify_team_access("id")
 def delete_team():
-    t = team_controller.get_team_with_id(g.payload["teamID"])
-    t.delete()
+    team_controller.delete_team(g.team.id)
     return response(success=True)
 
 
 @team.route("/members", methods=["POST"])
 @validate("modify_members")
-@verify_team_access
+@verify_team_access("id")
 def add_team_member():
-    if team_controller.is_user_team_member(g.payload["teamID"], g.payload["userID"]):
+    if team_controller.is_user_team_member(g.team.id, g.payload["userID"]):
         raise UserExistInTeamError()
 
     u = user_controller.get_user_by_id(id=g.payload["userID"])
@@ -117,53 +207,108 @@ def add_team_member():
     m.mail = u.mail
     m.role = u.role
 
-    t = team_controller.get_team_with_id(g.payload["teamID"])
-    t.members.append(m)
-    t.save()
+    # Fails if the user has been added in the meantime
+    if not team_controller.add_members_to_team(g.team.id, [m]):
+        raise UserExistInTeamError()
     return response(success=True)
 
 
 @team.route("/members", methods=["DELETE"])
 @validate("modify_members")
-@verify_team_access
+@verify_team_access("id")
 def delete_team_member():
-    if not team_controller.is_user_team_member(
-        g.payload["teamID"], g.payload["userID"]
-    ):
+    if not team_controller.is_user_team_member(g.team.id, g.payload["userID"]):
         raise UserNotExistError()
 
-    team_controller.remove_user_from_team(g.payload["teamID"], g.payload["userID"])
+    team_controller.remove_user_from_team(g.team.id, g.payload["userID"])
     return response(success=True)
 
 
+@team.route("/members/batch", methods=["POST"])
+@validate("modify_members_batch")
+@verify_team_access("id")
+def add_team_members():
+    team_id = g.team.id
+    user_ids = g.payload["userIDs"]
+    users = {
+        str(u.id): u
+        for u in user_controller.get_users_by_ids(
+            [i for i in user_ids if ObjectId.is_valid(i)]
+        )
+    }
+
+    # Users added concurrently by someone else are skipped, retry with the
+    # remaining ones in that case
+    added = set()
+    for _ in range(3):
+        existing = team_controller.get_team_member_ids(team_id, user_ids) - added
+        members = []
+        for user_id in user_ids:
+            if user_id in users and user_id not in existing | added:
+                u = users[user_id]
+                m = TeamMember()
+                m.user_id = user_id
+                m.first_name = u.first_name
+                m.last_name = u.last_name
+                m.mail = u.mail
+                m.role = u.role
+                members.append(m)
+
+        if members:
+            added.update(team_controller.add_members_to_team(team_id, members))
+        if all(m.user_id in added for m in members):
+            break
+    else:
+        raise TeamModifiedError()
+
+    results = []
+    for user_id in user_ids:
+        if user_id in added:
+            results.append({"userID": user_id, "status": "added"})
+        elif user_id in existing:
+            results.append({"userID": user_id, "status": "already_member"})
+        else:
+            results.append({"userID": user_id, "status": "not_found"})
+    return response(payload={"results": results})
+
+
+@team.route("/members/batch", methods=["DELETE"])
+@validate("modify_members_batch")
+@verify_team_access("id")
+def delete_team_members():
+    existing = team_controller.get_team_member_ids(g.team.id, g.payload["userIDs"])
+    results = [
+        {
+            "userID": user_id,
+            "status": "removed" if user_id in existing else "not_member",
+        }
+        for user_id in g.payload["userIDs"]
+    ]
+
+    team_controller.remove_users_from_team(g.team.id, existing)
+    return response(payload={"results": results})
+
+
 @team.route("/change_role", methods=["PATCH"])
 @validate("change_user_role")
-@verify_team_access
+@verify_team_access("admin", "version")
 def change_user_role():
-    if not team_controller.is_user_team_member(
-        g.payload["teamID"], g.payload["userID"]
-    ):
-        raise UserNotExistError()
-
-    t = team_controller.get_team_with_id(g.payload["teamID"])
-    if g.payload["role"] == "user":
-        if g.payload["userID"] not in t.admin:
+    user_id = g.payload["userID"]
+    role = g.payload["role"]
+
+    # The update only applies to the loaded version of the team, reload and
+    # check again if someone else modified it in the meantime
+    t = g.team
+    for _ in range(config.TEAM_UPDATE_RETRIES):
+        if not team_controller.is_user_team_member(t.id, user_id):
+            raise UserNotExistError()
+        if (user_id in t.admin) == (role == "admin"):
             raise UserAlreadySameRoleError()
 
-        team_controller.update_user_role(
-            g.payload["teamID"], g.payload["userID"], "user"
-        )
-        t.admin.remove(g.payload["userID"])
-    elif g.payload["role"] == "admin":
-        if g.payload["userID"] in t.admin:
-            raise UserAlreadySameRoleError()
-
-        team_controller.update_user_role(
-            g.payload["teamID"], g.payload["userID"], "admin"
-        )
-        t.admin.append(g.payload["userID"])
-    t.save()
-    return response(success=True)
+        if team_controller.change_member_role(t.id, user_id, role, t.version):
+            return response(success=True)
+        t = _load_team(t.id, admin=True, fields=("admin", "version"))
+    raise TeamModifiedError()
 
 
 def _check_team_available(name):
@@ -213,6 +358,15 @@ class UserNotExistError(APIException):
         )
 
 
+class TeamModifiedError(APIException):
+    def __init__(self):
+        super(TeamModifiedError, self).__init__(
+            status_code=409,
+            error_code=1209,
+            message="The team was modified concurrently, please try again.",
+        )
+
+
 class UserAlreadySameRoleError(APIException):
     def __init__(self):
         super(UserAlreadySameRoleError, self).__init__(
@@ -3,14 +3,15 @@
 Blueprint defining routes for user and session management.
 """
 
-import hashlib
-import time
-import random
-
 from flask import Blueprint, g
+from mongoengine.errors import NotUniqueError
 
 import auth
+import config
+import password
+import profile_sync
 from auth import noauth
+from ratelimit import rate_limit
 from controller import user as user_controller
 from error import APIException
 from util import response, validate
@@ -35,6 +36,7 @@ def get_user_data():
 
 @user.route("/register", methods=["POST"])
 @noauth
+@rate_limit(ip=config.RATE_LIMIT_REGISTER_IP, mail=config.RATE_LIMIT_REGISTER_MAIL)
 @validate("user_registration")
 def register_user():
     if _check_password(g.payload["password"]):
@@ -53,13 +55,15 @@ def register_user():
             else:
                 u.role = "user"
 
-            password_salt = _hash(str(time.time()) + str(random.random()))
-            password_hash = _hash(g.payload["password"] + password_salt)
-
-            u.password_hash = password_hash
-            u.password_salt = password_salt
+            u.password_hash, u.password_salt = password.hash_password(
+                g.payload["password"]
+            )
 
-            u.save()
+            try:
+                u.save()
+            except NotUniqueError:
+                # Registered concurrently
+                raise UsernameTakenError()
             return response(success=True)
         else:
             raise UsernameTakenError()
@@ -71,6 +75,7 @@ def register_user():
 @validate("user_update")
 def update_user_details():
     u = user_controller.get_user_by_id(id=g.session["userID"])
+    profile = (u.first_name, u.last_name)
 
     if "firstName" in g.payload:
         u.first_name = g.payload["firstName"]
@@ -84,27 +89,36 @@ def update_user_details():
 
     if "password" in g.payload:
         if _check_password(g.payload["password"]):
-            password_salt = _hash(str(time.time()) + str(random.random()))
-            password_hash = _hash(g.payload["password"] + password_salt)
-
-            u.password_hash = password_hash
-            u.password_salt = password_salt
+            u.password_hash, u.password_salt = password.hash_password(
+                g.payload["password"]
+            )
         else:
             raise InvalidPasswordFormatError()
 
     u.save()
+    if profile != (u.first_name, u.last_name):
+        # Copies in the teams of the user are updated asynchronously
+        profile_sync.enqueue(u)
     return response(success=True)
 
 
 @user.route("/login", methods=["POST"])
 @noauth
+@rate_limit(ip=config.RATE_LIMIT_LOGIN_IP, mail=config.RATE_LIMIT_LOGIN_MAIL)
 @validate("user_login")
 def user_login():
     try:
         u = user_controller.get_user_by_mail(mail=g.payload["mail"])
 
-        password_hash = _hash(g.payload["password"] + u.password_salt)
-        if password_hash == u.password_hash:
+        if password.verify_password(
+            g.payload["password"], u.password_hash, u.password_salt
+        ):
+            if password.needs_rehash(u.password_hash):
+                # Upgrade hashes created with legacy or outdated settings
+                u.password_hash, u.password_salt = password.hash_password(
+                    g.payload["password"]
+                )
+                u.save()
             token = auth.start_session(u.id, u.role)
             return response(payload={"token": token})
         else:
@@ -127,10 +141,6 @@ def _mail_available(mail):
     return User.objects(mail=mail).count() == 0
 
 
-def _hash(string):
-    return str(hashlib.sha1(string.encode("utf-8")).hexdigest())
-
-
 class InvalidPasswordFormatError(APIException):
     def __init__(self):
         super(InvalidPasswordFormatError, self).__init__(
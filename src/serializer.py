@@ -0,0 +1,118 @@
+""" Response serialization
+
+Encodes raw PyMongo documents to JSON bytes without building MongoEngine
+documents first. The output matches what jsonify produces for documents
+(ObjectIds as {"$oid": ...}, sorted keys). orjson is used if installed.
+
+Encoded teams are cached per process by team ID and version. Every mutation
+of a team increments its version, so outdated entries are never served, and
+mutations in this process drop them right away.
+"""
+
+import json
+import threading
+import uuid
+from collections import OrderedDict
+
+from bson import ObjectId
+
+import config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Fields of raw team documents which are not part of the API
+_TEAM_INTERNAL_FIELDS = ("version",)
+
+
+def _default(obj):
+    if isinstance(obj, ObjectId):
+        return {"$oid": str(obj)}
+    if isinstance(obj, uuid.UUID):
+        # Session tokens, encoded like jsonify and orjson do
+        return str(obj)
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+
+if orjson is not None:
+
+    def dumps(obj):
+        """Encodes an object containing ObjectIds to JSON bytes"""
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_SORT_KEYS)
+
+else:
+
+    def dumps(obj):
+        """Encodes an object containing ObjectIds to JSON bytes"""
+        return json.dumps(
+            obj, default=_default, separators=(",", ":"), sort_keys=True
+        ).encode("utf-8")
+
+
+def encode_team(raw):
+    """Encodes a raw team document"""
+    for field in _TEAM_INTERNAL_FIELDS:
+        if field in raw:
+            raw = {k: v for k, v in raw.items() if k not in _TEAM_INTERNAL_FIELDS}
+            break
+    return dumps(raw)
+
+
+class PayloadCache(object):
+    """Bounded LRU cache of encoded payloads by ID and version"""
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, version, payload):
+        with self._lock:
+            self._entries[key] = (version, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+team_cache = PayloadCache(config.TEAM_CACHE_SIZE)
+
+
+def get_team_payload(team_id, version):
+    """Returns the cached encoded team of the given version or None"""
+    return team_cache.get(str(team_id), version)
+
+
+def put_team_payload(team_id, raw):
+    """Encodes a raw team and caches it under its version"""
+    payload = encode_team(raw)
+    team_cache.put(str(team_id), raw.get("version", 0), payload)
+    return payload
+
+
+def team_payload(team_id, version, load):
+    """Returns the encoded team, load() returns the raw team on cache misses
+
+    None is returned if load() does not find the team.
+    """
+    payload = get_team_payload(team_id, version)
+    if payload is None:
+        raw = load()
+        if raw is None:
+            return None
+        # The loaded team may already be newer than the requested version
+        payload = put_team_payload(team_id, raw)
+    return payload
@@ -0,0 +1,56 @@
+""" Session codec benchmark
+
+Running this module compares encode and decode time and the stored size of
+a session between pickle and the compact session codec.
+"""
+
+import sys
+import os
+
+PACKAGE_PARENT = ".."
+SCRIPT_DIR = os.path.dirname(
+    os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__)))
+)
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+import argparse
+import time
+import timeit
+import uuid
+
+from bson import ObjectId
+
+from codec import PickleCodec, SessionCodec
+
+
+def measure(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=100000)
+    args = parser.parse_args()
+
+    session = {
+        "userID": ObjectId(),
+        "userRole": "user",
+        "clientIP": "172.31.14.107",
+        "expireDate": time.time() + 60 * 30,
+        "sessionToken": uuid.uuid4(),
+    }
+
+    print(
+        "{:>8} {:>12} {:>12} {:>8}".format("codec", "encode us", "decode us", "bytes")
+    )
+    for name, codec in (("pickle", PickleCodec()), ("session", SessionCodec())):
+        raw = codec.dumps(session)
+        assert codec.loads(raw) == session
+        print(
+            "{:>8} {:>12.2f} {:>12.2f} {:>8}".format(
+                name,
+                measure(lambda: codec.dumps(session), args.number),
+                measure(lambda: codec.loads(raw), args.number),
+                len(raw),
+            )
+        )
@@ -0,0 +1,103 @@
+""" Session write benchmark
+
+Running this module compares the throughput of session writes through
+RedisAdapter with the former lock based write path at 1, 8 and 64
+concurrent writers. It needs a running redis server at config.REDIS.
+"""
+
+import sys
+import os
+
+PACKAGE_PARENT = ".."
+SCRIPT_DIR = os.path.dirname(
+    os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__)))
+)
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+import argparse
+import pickle
+import threading
+import time
+import uuid
+
+import config
+import RedisAdapter
+
+
+WRITERS = (1, 8, 64)
+
+
+def locked_write(adapter, lock, key, value, expire_at):
+    """The write path used before pipelining, kept here as the reference"""
+    lock.acquire()
+    try:
+        adapter.db.sadd(adapter.mgmt_prefix + "keys", str(key))
+        adapter.db.set(adapter.var_prefix + str(key), pickle.dumps(value))
+    finally:
+        lock.release()
+    adapter.db.expireat(adapter.var_prefix + str(key), expire_at)
+    adapter.db.srem(adapter.mgmt_prefix + "keys", str(key))
+
+
+def pipelined_write(adapter, lock, key, value, expire_at):
+    adapter.set(key, value, expire_at=expire_at)
+
+
+def run(write, writers, duration):
+    adapter = RedisAdapter.RedisAdapter("benchmark")
+    tokens = [str(uuid.uuid4()) for _ in range(writers)]
+    counts = [0] * writers
+    stop = threading.Event()
+
+    def worker(i):
+        # Every writer holds its own lock object on the shared lock key,
+        # exactly like separate uWSGI workers did.
+        lock = adapter.db.lock(adapter.mgmt_prefix + "keys_lock")
+        session = {
+            "userID": i,
+            "userRole": "user",
+            "clientIP": "127.0.0.1",
+            "sessionToken": tokens[i],
+        }
+        while not stop.is_set():
+            session["expireDate"] = time.time() + 60
+            write(adapter, lock, tokens[i], session, int(session["expireDate"]))
+            counts[i] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(writers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    for token in tokens:
+        adapter.unset(token)
+    return sum(counts) / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--redis", default=config.REDIS, help="host:port")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds")
+    args = parser.parse_args()
+
+    config.REDIS = args.redis
+    config.REDIS_MAX_CONNECTIONS = max(WRITERS)
+
+    print(
+        "{:>8} {:>14} {:>14} {:>8}".format(
+            "writers", "locked/s", "pipelined/s", "ratio"
+        )
+    )
+    for writers in WRITERS:
+        locked = run(locked_write, writers, args.duration)
+        pipelined = run(pipelined_write, writers, args.duration)
+        print(
+            "{:>8} {:>14.0f} {:>14.0f} {:>7.1f}x".format(
+                writers, locked, pipelined, pipelined / locked
+            )
+        )
@@ -0,0 +1,91 @@
+""" Team serializer benchmark
+
+Running this module compares the time to encode a team response with
+jsonify of a MongoEngine document, the raw document serializer and its
+cache, for teams of 10, 1,000 and 10,000 members. It needs no database.
+"""
+
+import sys
+import os
+
+PACKAGE_PARENT = ".."
+SCRIPT_DIR = os.path.dirname(
+    os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__)))
+)
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+import argparse
+import timeit
+
+from bson import ObjectId
+from flask import Flask, jsonify
+from flask_mongoengine.json import override_json_encoder
+
+import serializer
+from model.Team import Team
+
+SIZES = (10, 1000, 10000)
+
+
+def raw_team(size):
+    """Builds a team document as returned by PyMongo"""
+    members = []
+    for i in range(size):
+        members.append(
+            {
+                "user_id": str(ObjectId()),
+                "mail": "member%d@example.com" % i,
+                "first_name": "First%d" % i,
+                "last_name": "Last%d" % i,
+                "role": "admin" if i == 0 else "user",
+            }
+        )
+    return {
+        "_id": ObjectId(),
+        "name": "team%d" % size,
+        "admin": [members[0]["user_id"]],
+        "members": members,
+        "version": 1,
+    }
+
+
+def measure(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number * 1e3
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=10)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    override_json_encoder(app)
+
+    print("encoder: %s" % ("orjson" if serializer.orjson is not None else "json"))
+    print(
+        "{:>8} {:>14} {:>14} {:>14}".format(
+            "members", "jsonify ms", "serializer ms", "cached ms"
+        )
+    )
+    with app.app_context():
+        for size in SIZES:
+            raw = raw_team(size)
+
+            def current():
+                # The former path: build the document, then jsonify it
+                return jsonify(payload=Team._from_son(raw)).get_data()
+
+            def uncached():
+                return serializer.encode_team(raw)
+
+            def cached():
+                return serializer.team_payload(raw["_id"], 1, lambda: raw)
+
+            print(
+                "{:>8} {:>14.3f} {:>14.3f} {:>14.4f}".format(
+                    size,
+                    measure(current, args.number),
+                    measure(uncached, args.number),
+                    measure(cached, args.number),
+                )
+            )
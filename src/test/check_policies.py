@@ -0,0 +1,113 @@
+""" Access policy check
+
+Running this module compares the access policies of the app's routes (see
+policy.py) with openapi.yaml: routes documented as public (security: [])
+have to be public and the other way round, and rate limited routes have to
+document their 429 response. Routes missing in either place are listed as
+warnings. With --export the policy table is printed as JSON instead.
+
+Needs PyYAML (pip install pyyaml).
+"""
+
+import sys
+import os
+
+PACKAGE_PARENT = ".."
+SCRIPT_DIR = os.path.dirname(
+    os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__)))
+)
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+import argparse
+import json
+
+import config
+
+OPENAPI = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "..", "openapi.yaml"))
+
+
+def load_operations(path):
+    """Returns the documented operations by (path, method)"""
+    try:
+        import yaml
+    except ImportError:
+        sys.exit("Checking the policies needs PyYAML to be installed")
+    with open(path, "r") as f:
+        spec = yaml.safe_load(f)
+
+    default_public = spec.get("security") == []
+    operations = {}
+    for route, methods in spec.get("paths", {}).items():
+        for method, operation in methods.items():
+            security = operation.get("security")
+            operations[(route, method.upper())] = {
+                "public": default_public if security is None else security == [],
+                "rateLimited": 429 in operation.get("responses", {}),
+            }
+    return operations
+
+
+def check(routes, operations, base_route):
+    """Returns the errors and warnings of comparing routes with operations"""
+    errors = []
+    warnings = []
+    served = set()
+    for route in routes:
+        if not route["path"].startswith(base_route + "/"):
+            # Static files of Flask
+            continue
+        key = (route["path"][len(base_route) :], route["method"])
+        served.add(key)
+        name = "%s %s" % (key[1], key[0])
+        operation = operations.get(key)
+        if operation is None:
+            warnings.append("%s is not documented" % name)
+            continue
+        if operation["public"] != route["public"]:
+            errors.append(
+                "%s is %s but documented as %s"
+                % (
+                    name,
+                    "public" if route["public"] else "authenticated",
+                    "public" if operation["public"] else "authenticated",
+                )
+            )
+        if operation["rateLimited"] != bool(route["rateLimits"]):
+            errors.append(
+                "%s is %srate limited but %sdocuments a 429 response"
+                % (
+                    name,
+                    "" if route["rateLimits"] else "not ",
+                    "" if operation["rateLimited"] else "never ",
+                )
+            )
+
+    for route, method in sorted(set(operations) - served):
+        warnings.append("%s %s is documented but not served" % (method, route))
+    return errors, warnings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--openapi", default=OPENAPI)
+    parser.add_argument(
+        "--export", action="store_true", help="print the policy table as JSON"
+    )
+    args = parser.parse_args()
+
+    # Only the routes are needed, not the database
+    config.MONGO_SYNC_INDEXES = False
+    import main
+    import policy
+
+    routes = policy.export(main.app, main.policies)
+    if args.export:
+        print(json.dumps(routes, indent=2))
+        sys.exit(0)
+
+    errors, warnings = check(routes, load_operations(args.openapi), main.BASE_ROUTE)
+    for w in warnings:
+        print("WARNING: " + w)
+    for e in errors:
+        print("ERROR: " + e)
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,83 @@
+""" Rate limit check
+
+Running this module starts the app of main.py in process on fakeredis and
+mongomock (pip install "fakeredis[lua]" mongomock) and checks that CORS
+preflight requests never count against the login rate limits: more
+preflights than the per-IP limit allows are followed by a real login,
+which has to succeed. It also checks that failed logins to one account
+from many addresses are limited per mail address.
+"""
+
+import sys
+import os
+
+PACKAGE_PARENT = ".."
+SCRIPT_DIR = os.path.dirname(
+    os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__)))
+)
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+import config
+from loadtest import BASE_ROUTE, use_fake_backends
+
+MAIL = "ratelimit@check.local"
+PASSWORD = "ratelimit"
+# Account attacked from many addresses
+TARGET_MAIL = "target@check.local"
+
+
+def check_preflights(http):
+    """Returns the errors of sending preflights before a login"""
+    errors = []
+    r = http.post(
+        BASE_ROUTE + "/user/register", json={"mail": MAIL, "password": PASSWORD}
+    )
+    if r.status_code != 200:
+        return ["Registering the user failed with %d" % r.status_code]
+
+    for _ in range(config.RATE_LIMIT_LOGIN_IP[0] + 5):
+        r = http.options(
+            BASE_ROUTE + "/user/login",
+            headers={
+                "Origin": "https://app.bluquist.com",
+                "Access-Control-Request-Method": "POST",
+            },
+        )
+        if r.status_code == 429:
+            errors.append("A preflight request was rate limited")
+            break
+
+    r = http.post(BASE_ROUTE + "/user/login", json={"mail": MAIL, "password": PASSWORD})
+    if r.status_code != 200:
+        errors.append("The login after the preflights failed with %d" % r.status_code)
+    return errors
+
+
+def check_distributed_attempts(http):
+    """Returns the errors of failed logins to one account from many addresses"""
+    limit = config.RATE_LIMIT_LOGIN_MAIL[0]
+    for i in range(limit + 1):
+        r = http.post(
+            BASE_ROUTE + "/user/login",
+            json={"mail": " %s " % TARGET_MAIL.upper(), "password": "wrong"},
+            environ_base={"REMOTE_ADDR": "198.51.100.%d" % (i % 250 + 1)},
+        )
+        if r.status_code == 429:
+            if i < limit:
+                return ["Attempt %d of %d was rate limited" % (i + 1, limit)]
+            return []
+    return ["%d attempts from different addresses were not limited" % (limit + 1)]
+
+
+if __name__ == "__main__":
+    use_fake_backends()
+    config.RATE_LIMIT_ENABLED = True
+    from main import app
+
+    http = app.test_client()
+    errors = check_preflights(http) + check_distributed_attempts(http)
+    for e in errors:
+        print("ERROR: " + e)
+    if not errors:
+        print("All rate limit checks passed")
+    sys.exit(1 if errors else 0)
@@ -12,15 +12,13 @@ SCRIPT_DIR = os.path.dirname(
 )
 sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
 
-import time
-import random
 from pymongo import MongoClient
 from flask import Flask
 
 import config
 import database
 from model.User import User, UserRole
-from routes.user.route import _hash
+import password
 
 
 if __name__ == "__main__":
@@ -40,7 +38,4 @@ if __name__ == "__main__":
     u = User()
     u.mail = "test@user.com"
     u.role = UserRole.USER
-    password_salt = _hash(str(time.time()) + str(random.random()))
-    password_hash = _hash("test123" + password_salt)
-    u.password_hash = password_hash
-    u.password_salt = password_salt
+    u.password_hash, u.password_salt = password.hash_password("test123")
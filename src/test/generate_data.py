@@ -0,0 +1,257 @@
+""" Bulk test data generator
+
+Running this module fills the configured database with synthetic users and
+teams at production scale. Team sizes follow a power law and popular users
+are members of many teams. Documents are written with unordered insert_many
+batches from several processes, all users share a few pre-hashed passwords
+and the indexes are built once all documents are written.
+
+IDs, names and memberships only depend on the seed, so runs with the same
+arguments produce the same data.
+"""
+
+import sys
+import os
+
+PACKAGE_PARENT = ".."
+SCRIPT_DIR = os.path.dirname(
+    os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__)))
+)
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+import argparse
+import multiprocessing
+import random
+import struct
+import time
+
+import mongoengine
+from bson import ObjectId
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+
+import config
+import indexes
+import password
+from model.Team import Team, TeamMembership
+from model.User import User
+
+# Fixed timestamps of the generated IDs, users and teams differ in them
+USER_ID_TIME = 0x60000000
+TEAM_ID_TIME = 0x60000001
+
+# Duplicate key errors for documents written by a previous run
+DUPLICATE_KEY = 11000
+
+_database = None
+_database_pid = None
+
+
+def _get_database():
+    global _database, _database_pid
+    if _database_pid != os.getpid():
+        _database = MongoClient(config.MONGO).get_default_database()
+        _database_pid = os.getpid()
+    return _database
+
+
+def _insert(model, docs):
+    if not docs:
+        return 0
+    collection = _get_database()[model._get_collection_name()]
+    try:
+        return len(collection.insert_many(docs, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        if any(err["code"] != DUPLICATE_KEY for err in e.details["writeErrors"]):
+            raise
+        return e.details["nInserted"]
+
+
+def user_id(i):
+    return ObjectId(struct.pack(">IQ", USER_ID_TIME, i))
+
+
+def team_id(i):
+    return ObjectId(struct.pack(">IQ", TEAM_ID_TIME, i))
+
+
+def user_profile(i):
+    return {"mail": "user%d@example.com" % i, "first_name": "User", "last_name": str(i)}
+
+
+def insert_users(task):
+    """Writes the users of an index range, returns the number of new ones"""
+    start, end, hashes, batch_size = task
+    count = 0
+    docs = []
+    for i in range(start, end):
+        password_hash, password_salt = hashes[i % len(hashes)]
+        doc = user_profile(i)
+        doc.update(
+            _id=user_id(i),
+            role="user",
+            password_hash=password_hash,
+            password_salt=password_salt,
+        )
+        docs.append(doc)
+        if len(docs) == batch_size:
+            count += _insert(User, docs)
+            docs = []
+    return count + _insert(User, docs)
+
+
+def team_size(rng, minimum, maximum, exponent):
+    """Draws a size from a Pareto distribution cut off at maximum"""
+    return min(maximum, int(minimum * (1 - rng.random()) ** (-1 / (exponent - 1))))
+
+
+def team_members(rng, size, users, skew):
+    """Draws distinct member indexes, low indexes are drawn far more often"""
+    size = min(size, users)
+    if size > users // 2:
+        # Rejection sampling gets slow for teams of nearly all users
+        return rng.sample(range(users), size)
+    members = set()
+    while len(members) < size:
+        members.add(int(users * rng.random() ** skew))
+    return list(members)
+
+
+def insert_teams(task):
+    """Writes the teams of an index range, returns the new team and membership counts"""
+    start, end, options = task
+    rng = random.Random("%d-%d" % (options["seed"], start))
+    teams = []
+    memberships = []
+    counts = [0, 0]
+
+    for i in range(start, end):
+        size = team_size(
+            rng, options["min_team_size"], options["max_team_size"], options["exponent"]
+        )
+        members = []
+        for n, member in enumerate(
+            team_members(rng, size, options["users"], options["skew"])
+        ):
+            m = user_profile(member)
+            m.update(user_id=str(user_id(member)), role="admin" if n == 0 else "user")
+            members.append(m)
+
+        doc = {
+            "_id": team_id(i),
+            "name": "team%d" % i,
+            "admin": [members[0]["user_id"]],
+            "members": [],
+            "version": 0,
+        }
+        if options["storage"] == "collection":
+            memberships.extend(dict(m, team_id=doc["_id"]) for m in members)
+        else:
+            doc["members"] = members
+        teams.append(doc)
+
+        if (
+            len(teams) >= options["batch_size"]
+            or len(memberships) >= options["batch_size"]
+        ):
+            counts[0] += _insert(Team, teams)
+            counts[1] += _insert(TeamMembership, memberships)
+            teams = []
+            memberships = []
+
+    counts[0] += _insert(Team, teams)
+    counts[1] += _insert(TeamMembership, memberships)
+    return counts
+
+
+def chunks(total, size):
+    return [(start, min(total, start + size)) for start in range(0, total, size)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--teams", type=int, default=100000)
+    parser.add_argument("--min-team-size", type=int, default=2)
+    parser.add_argument("--max-team-size", type=int, default=10000)
+    parser.add_argument(
+        "--exponent",
+        type=float,
+        default=2.2,
+        help="power law exponent of the team sizes, smaller means larger teams",
+    )
+    parser.add_argument(
+        "--skew",
+        type=float,
+        default=3.0,
+        help="how strongly memberships concentrate on few users, 1 is uniform",
+    )
+    parser.add_argument(
+        "--storage",
+        choices=("embedded", "collection"),
+        default=config.TEAM_MEMBERSHIP_STORAGE,
+        help="where team members are stored, see TEAM_MEMBERSHIP_STORAGE",
+    )
+    parser.add_argument("--password", default="test123")
+    parser.add_argument(
+        "--password-hashes",
+        type=int,
+        default=16,
+        help="number of distinct salts, users share the resulting hashes",
+    )
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--wipe", action="store_true", help="drop users, teams and memberships first"
+    )
+    args = parser.parse_args()
+    if args.exponent <= 1:
+        parser.error("--exponent must be greater than 1")
+    if args.teams and not args.users:
+        parser.error("teams need at least one user")
+
+    database = _get_database()
+    if args.wipe:
+        print("Drop users and teams")
+        for model in (User, Team, TeamMembership):
+            database.drop_collection(model._get_collection_name())
+
+    start = time.time()
+    with multiprocessing.Pool(args.processes) as pool:
+        hashes = pool.map(
+            password.hash_password, [args.password] * args.password_hashes
+        )
+        print("Hashed %d passwords in %.1fs" % (len(hashes), time.time() - start))
+
+        # Tasks are small enough to balance the load between processes
+        chunk_size = max(1, min(args.batch_size, args.users // (4 * args.processes)))
+        users = sum(
+            pool.imap_unordered(
+                insert_users,
+                [
+                    (s, e, hashes, args.batch_size)
+                    for s, e in chunks(args.users, chunk_size)
+                ],
+            )
+        )
+        print("Inserted %d users after %.1fs" % (users, time.time() - start))
+
+        options = dict(vars(args))
+        chunk_size = max(1, min(args.batch_size, args.teams // (4 * args.processes)))
+        teams = memberships = 0
+        for counts in pool.imap_unordered(
+            insert_teams,
+            [(s, e, options) for s, e in chunks(args.teams, chunk_size)],
+        ):
+            teams += counts[0]
+            memberships += counts[1]
+        print(
+            "Inserted %d teams and %d separate memberships after %.1fs"
+            % (teams, memberships, time.time() - start)
+        )
+
+    # Building indexes once is much faster than maintaining them while writing
+    mongoengine.connect(host=config.MONGO)
+    indexes.sync_indexes()
+    print("Built indexes after %.1fs" % (time.time() - start))
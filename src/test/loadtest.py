@@ -0,0 +1,309 @@
+""" API load test
+
+Running this module starts the app of main.py in process, seeds users and
+teams and lets concurrent clients send a mixed workload (login, user info,
+team info, team listing and member churn) for a fixed time. Latency
+percentiles and requests per second of successful (2xx) responses are
+reported per endpoint as JSON, so results of different commits can be
+compared; all other responses are counted as failed by status code. Rate
+limiting is turned off unless --rate-limit is given, as all clients log in
+from the same address.
+
+By default redis and MongoDB are replaced by fakeredis and mongomock
+(pip install "fakeredis[lua]" mongomock). With --backend local the servers
+configured in config.py are used, all users and teams there are replaced.
+"""
+
+import sys
+import os
+
+PACKAGE_PARENT = ".."
+SCRIPT_DIR = os.path.dirname(
+    os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__)))
+)
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+import argparse
+import json
+import random
+import subprocess
+import threading
+import time
+from collections import defaultdict
+
+import mongoengine.connection
+import redis
+from bson import ObjectId
+
+import config
+
+BASE_ROUTE = "/bluquist/v" + config.VERSION
+PASSWORD = "loadtest"
+
+# Relative frequency of the client actions
+WORKLOAD = (
+    ("user_info", 35),
+    ("team_info", 25),
+    ("team_list", 20),
+    ("member_churn", 15),
+    ("login", 5),
+)
+
+
+def use_fake_backends():
+    """Replaces the redis and MongoDB clients by in-process stand-ins"""
+    try:
+        import fakeredis
+        import mongomock
+    except ImportError:
+        sys.exit("The fake backend needs fakeredis and mongomock to be installed")
+
+    server = fakeredis.FakeServer()
+
+    class FakeConnectionPool(redis.BlockingConnectionPool):
+        def __init__(self, *args, **kw):
+            kw["connection_class"] = fakeredis.FakeConnection
+            kw["server"] = server
+            super(FakeConnectionPool, self).__init__(*args, **kw)
+
+    redis.BlockingConnectionPool = FakeConnectionPool
+    mongoengine.connection.MongoClient = mongomock.MongoClient
+
+
+def seed(users, teams, team_size, rng):
+    """Creates users and teams, the admin of team i is user i"""
+    from model.Team import Team, TeamMembership
+    from model.User import User
+    import password
+
+    for model in (User, Team, TeamMembership):
+        model._get_collection().delete_many({})
+
+    # All users share one password, so it is only hashed once
+    password_hash, password_salt = password.hash_password(PASSWORD)
+    user_docs = [
+        {
+            "_id": ObjectId(),
+            "mail": "user%d@loadtest.local" % i,
+            "first_name": "User",
+            "last_name": str(i),
+            "role": "user",
+            "password_hash": password_hash,
+            "password_salt": password_salt,
+        }
+        for i in range(users)
+    ]
+    User._get_collection().insert_many(user_docs, ordered=False)
+
+    team_ids = []
+    team_docs = []
+    memberships = []
+    for i in range(teams):
+        admin = user_docs[i % users]
+        others = rng.sample(user_docs, min(users, team_size)) if team_size else []
+        members = [admin] + [u for u in others if u is not admin][: team_size - 1]
+        member_docs = [
+            {
+                "user_id": str(u["_id"]),
+                "mail": u["mail"],
+                "first_name": u["first_name"],
+                "last_name": u["last_name"],
+                "role": "admin" if u is admin else "user",
+            }
+            for u in members
+        ]
+        doc = {
+            "_id": ObjectId(),
+            "name": "loadtest-team-%d" % i,
+            "admin": [str(admin["_id"])],
+            "members": [],
+            "version": 0,
+        }
+        if config.TEAM_MEMBERSHIP_STORAGE == "collection":
+            memberships.extend(dict(m, team_id=doc["_id"]) for m in member_docs)
+        else:
+            doc["members"] = member_docs
+        team_docs.append(doc)
+        team_ids.append(str(doc["_id"]))
+
+    if team_docs:
+        Team._get_collection().insert_many(team_docs, ordered=False)
+    if memberships:
+        TeamMembership._get_collection().insert_many(memberships, ordered=False)
+    return [str(u["_id"]) for u in user_docs], team_ids
+
+
+class Client(threading.Thread):
+    """Sends requests as the admin of one team until the deadline"""
+
+    def __init__(self, app, index, user_ids, team_ids, deadline, seed):
+        super(Client, self).__init__()
+        self.http = app.test_client()
+        self.index = index
+        self.user_ids = user_ids
+        self.team_id = team_ids[index % len(team_ids)]
+        self.mail = "user%d@loadtest.local" % (index % len(team_ids) % len(user_ids))
+        self.deadline = deadline
+        self.random = random.Random(seed)
+        self.token = None
+        # Latencies in seconds of successful responses and status codes of
+        # all responses, by endpoint
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.error = None
+
+    def request(self, name, method, path, payload=None):
+        headers = {}
+        if self.token is not None:
+            headers["Authorization"] = "Bearer " + self.token
+        start = time.perf_counter()
+        r = self.http.open(
+            BASE_ROUTE + path, method=method, json=payload, headers=headers
+        )
+        r.get_data()
+        if 200 <= r.status_code < 300:
+            self.latencies[name].append(time.perf_counter() - start)
+        self.statuses[name][r.status_code] += 1
+        return r
+
+    def login(self):
+        r = self.request(
+            "POST /user/login",
+            "POST",
+            "/user/login",
+            {"mail": self.mail, "password": PASSWORD},
+        )
+        if r.status_code == 200:
+            self.token = r.get_json()["payload"]["token"]
+
+    def user_info(self):
+        self.request("GET /user/info", "GET", "/user/info")
+
+    def team_info(self):
+        self.request(
+            "GET /team/info?team_id", "GET", "/team/info?team_id=" + self.team_id
+        )
+
+    def team_list(self):
+        self.request("GET /team/info", "GET", "/team/info?limit=50")
+
+    def member_churn(self):
+        payload = {"teamID": self.team_id, "userID": self.random.choice(self.user_ids)}
+        r = self.request("POST /team/members", "POST", "/team/members", payload)
+        if r.status_code == 200:
+            self.request("DELETE /team/members", "DELETE", "/team/members", payload)
+
+    def run(self):
+        actions = [getattr(self, name) for name, _ in WORKLOAD]
+        weights = [weight for _, weight in WORKLOAD]
+        try:
+            self.login()
+            while time.time() < self.deadline:
+                self.random.choices(actions, weights)[0]()
+        except Exception as e:
+            self.error = e
+
+
+def percentile(values, p):
+    """Nearest rank percentile of sorted values"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def summarize(latencies, statuses, duration):
+    """Summary of an endpoint, latencies are those of successful responses"""
+    latencies = sorted(latencies)
+    return {
+        "requests": sum(statuses.values()),
+        "failed": sum(
+            count for code, count in statuses.items() if not 200 <= code < 300
+        ),
+        "requestsPerSecond": round(len(latencies) / duration, 1),
+        "p50Ms": round(percentile(latencies, 50) * 1e3, 3) if latencies else None,
+        "p99Ms": round(percentile(latencies, 99) * 1e3, 3) if latencies else None,
+        "statuses": {str(code): count for code, count in sorted(statuses.items())},
+    }
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=SCRIPT_DIR,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--backend", choices=("fake", "local"), default="fake")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--teams", type=int, default=100)
+    parser.add_argument("--team-size", type=int, default=20)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument(
+        "--rate-limit",
+        action="store_true",
+        help="keep the login rate limits, which most logins will then hit",
+    )
+    args = parser.parse_args()
+
+    if args.backend == "fake":
+        use_fake_backends()
+    # Applied by the route decorators when main is imported
+    config.RATE_LIMIT_ENABLED = args.rate_limit
+    from main import app
+
+    rng = random.Random(args.seed)
+    with app.app_context():
+        user_ids, team_ids = seed(args.users, args.teams, args.team_size, rng)
+
+    deadline = time.time() + args.duration
+    clients = [
+        Client(app, i, user_ids, team_ids, deadline, rng.random())
+        for i in range(args.clients)
+    ]
+    start = time.time()
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    duration = time.time() - start
+
+    for c in clients:
+        if c.error is not None:
+            raise c.error
+
+    latencies = defaultdict(list)
+    statuses = defaultdict(lambda: defaultdict(int))
+    for c in clients:
+        for name, values in c.latencies.items():
+            latencies[name].extend(values)
+            latencies["total"].extend(values)
+        for name, codes in c.statuses.items():
+            for code, count in codes.items():
+                statuses[name][code] += count
+                statuses["total"][code] += count
+
+    report = {
+        "commit": current_commit(),
+        "settings": vars(args),
+        "membershipStorage": config.TEAM_MEMBERSHIP_STORAGE,
+        "durationSeconds": round(duration, 3),
+        "endpoints": {
+            name: summarize(latencies[name], codes, duration)
+            for name, codes in sorted(statuses.items())
+        },
+    }
+    report = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    print(report)
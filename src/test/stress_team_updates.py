@@ -0,0 +1,176 @@
+""" Concurrent team update stress test
+
+Running this module creates a team and lets many threads change member
+roles and add and remove members of it at the same time, using the same
+controller calls and retries as the routes. Afterwards it checks that no
+update got lost: the admin list matches the member roles, every member
+added and not removed is still there, and the version was incremented once
+per applied update. It needs running MongoDB and redis servers at
+config.MONGO and config.REDIS, since the controller invalidates the cached
+team access in redis, and removes its team when done.
+"""
+
+import sys
+import os
+
+PACKAGE_PARENT = ".."
+SCRIPT_DIR = os.path.dirname(
+    os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__)))
+)
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+import argparse
+import random
+import threading
+import time
+import uuid
+
+import mongoengine
+from bson import ObjectId
+
+import config
+from controller import team as team_controller
+from model.Team import TeamMember
+
+
+def member(user_id, role="user"):
+    m = TeamMember()
+    m.user_id = user_id
+    m.mail = user_id + "@example.com"
+    m.role = role
+    return m
+
+
+class Worker(threading.Thread):
+    def __init__(self, team_id, role_members, operations, seed):
+        super(Worker, self).__init__()
+        self.team_id = team_id
+        self.role_members = role_members
+        self.operations = operations
+        self.random = random.Random(seed)
+        # User IDs this worker added and has not removed again
+        self.added = set()
+        self.applied = 0
+        self.conflicts = 0
+        self.failed = 0
+        self.error = None
+
+    def run(self):
+        try:
+            for _ in range(self.operations):
+                if self.random.random() < 0.5:
+                    self.change_role()
+                else:
+                    self.change_members()
+        except Exception as e:
+            self.error = e
+
+    def change_role(self):
+        """Same retry loop as the change_role route"""
+        user_id = self.random.choice(self.role_members)
+        for _ in range(config.TEAM_UPDATE_RETRIES):
+            t = team_controller.get_team_for_user(
+                self.team_id, fields=("admin", "version")
+            )
+            role = "user" if user_id in t.admin else "admin"
+            if team_controller.change_member_role(t.id, user_id, role, t.version):
+                self.applied += 1
+                return
+            self.conflicts += 1
+        self.failed += 1
+
+    def change_members(self):
+        if self.added and self.random.random() < 0.5:
+            user_id = self.added.pop()
+            team_controller.remove_users_from_team(self.team_id, [user_id])
+        else:
+            user_id = str(ObjectId())
+            if not team_controller.add_members_to_team(self.team_id, [member(user_id)]):
+                raise AssertionError("Adding a new member failed")
+            self.added.add(user_id)
+        self.applied += 1
+
+
+def check(team_id, workers, initial_version):
+    t = team_controller.get_team_for_user(team_id)
+    roles = {m.user_id: m.role for m in t.members}
+
+    errors = []
+    admins = {user_id for user_id, role in roles.items() if role == "admin"}
+    if admins != set(t.admin):
+        errors.append(
+            "admin list %s does not match member roles %s"
+            % (sorted(t.admin), sorted(admins))
+        )
+
+    expected = set().union(*(w.added for w in workers))
+    expected.update(workers[0].role_members)
+    if expected != set(roles):
+        errors.append(
+            "%d members missing, %d unexpected"
+            % (len(expected - set(roles)), len(set(roles) - expected))
+        )
+
+    if config.TEAM_MEMBERSHIP_STORAGE == "embedded":
+        # Role changes of separate memberships increment the version twice
+        applied = sum(w.applied for w in workers)
+        if t.version != initial_version + applied:
+            errors.append(
+                "version %d after %d updates starting at %d"
+                % (t.version, applied, initial_version)
+            )
+    return errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--operations", type=int, default=200)
+    parser.add_argument("--members", type=int, default=8)
+    args = parser.parse_args()
+
+    mongoengine.connect(host=config.MONGO)
+
+    role_members = [str(ObjectId()) for _ in range(args.members)]
+    t = team_controller.create_team(
+        "stress-" + uuid.uuid4().hex, member(role_members[0], "admin")
+    )
+    team_controller.add_members_to_team(
+        t.id, [member(user_id) for user_id in role_members[1:]]
+    )
+    initial_version = team_controller.get_team_for_user(t.id, fields=("version",))
+    initial_version = initial_version.version
+
+    workers = [
+        Worker(t.id, role_members, args.operations, seed)
+        for seed in range(args.threads)
+    ]
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    duration = time.time() - start
+
+    try:
+        for w in workers:
+            if w.error is not None:
+                raise w.error
+        applied = sum(w.applied for w in workers)
+        print(
+            "%d updates in %.2fs (%.0f/s), %d conflicts retried, %d gave up"
+            % (
+                applied,
+                duration,
+                applied / duration,
+                sum(w.conflicts for w in workers),
+                sum(w.failed for w in workers),
+            )
+        )
+        errors = check(t.id, workers, initial_version)
+    finally:
+        team_controller.delete_team(t.id)
+
+    for e in errors:
+        print("ERROR: " + e)
+    sys.exit(1 if errors else 0)
@@ -5,45 +5,116 @@ all submodules.
 """
 
 from functools import wraps
-from flask import request, g, jsonify, Response
+from flask import request, g, Response, stream_with_context
 import jsonschema
+import config
 import error
+import metrics
+import serializer
 import json
+import os
+
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+SCHEMA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema")
+
+# Compiled validators by schema name, shared by all requests of a process
+_validators = {}
 
 
 def get_request_ip():
     """Returns the requester's IP address regardless of proxying webservers and spoofed headers"""
-    if request.headers.getlist("X-Forwarded-For"):
-        return request.headers.getlist("X-Forwarded-For")[0]
+    return resolve_request_ip(
+        request.headers.getlist("X-Forwarded-For"),
+        request.access_route,
+        request.remote_addr,
+    )
+
+
+def resolve_request_ip(forwarded_for, access_route, remote_addr):
+    """Picks the requester's IP address from the values of a request"""
+    if forwarded_for:
+        return forwarded_for[0]
+    else:
+        return resolve_peer_ip(access_route, remote_addr)
+
+
+def get_peer_ip():
+    """Returns the address our own proxies received the request from
+
+    Unlike get_request_ip(), clients cannot choose this address by sending
+    their own X-Forwarded-For header.
+    """
+    return resolve_peer_ip(request.access_route, request.remote_addr)
+
+
+def resolve_peer_ip(access_route, remote_addr):
+    """Picks the right-most address of the route not added by a trusted proxy"""
+    trusted_proxies = {"127.0.0.1", "172.31.14.107", "172.31.17.13"}
+    route = access_route + [remote_addr]
+
+    return next(
+        (addr for addr in reversed(route) if addr not in trusted_proxies),
+        remote_addr,
+    )
+
+
+def _compile_schema(definition):
+    """Compiles a schema definition into a function raising MalformedPayloadException"""
+    if config.SCHEMA_FAST_PATH and fastjsonschema is not None:
+        # Generates python code specialized for the schema
+        fast_validate = fastjsonschema.compile(definition)
+
+        def validate_payload(payload):
+            try:
+                fast_validate(payload)
+            except fastjsonschema.JsonSchemaValueException as e:
+                raise error.MalformedPayloadException(e.message)
+
     else:
-        trusted_proxies = {"127.0.0.1", "172.31.14.107", "172.31.17.13"}
-        route = request.access_route + [request.remote_addr]
+        cls = jsonschema.validators.validator_for(definition)
+        cls.check_schema(definition)
+        validator = cls(definition, format_checker=jsonschema.FormatChecker())
+
+        def validate_payload(payload):
+            e = jsonschema.exceptions.best_match(validator.iter_errors(payload))
+            if e is not None:
+                raise error.MalformedPayloadException(e.message)
+
+    return validate_payload
 
-        return next(
-            (addr for addr in reversed(route) if addr not in trusted_proxies),
-            request.remote_addr,
-        )
+
+def get_validator(schema):
+    """Returns the compiled validator for a schema of the schema directory"""
+    validator = _validators.get(schema)
+    if validator is None:
+        with open(os.path.join(SCHEMA_DIR, schema + ".json"), "r") as f:
+            validator = _compile_schema(json.load(f))
+        _validators[schema] = validator
+    return validator
 
 
 def validate(schema):
     """Decorator to validate the JSON payload against a JSON schema"""
 
     def decorator(f):
-        @wraps(f)
-        def wrapper(*args, **kw):
+        # Schemas are loaded and compiled once, when the route is defined
+        validate_payload = get_validator(schema)
+
+        @metrics.timed("validate")
+        def load_payload():
             payload = request.get_json()
             if payload is None:
                 raise error.NoJsonPayloadException()
-            else:
-                try:
-                    jsonschema.validate(
-                        payload,
-                        json.load(open("schema/" + schema + ".json", "r")),
-                        format_checker=jsonschema.FormatChecker(),
-                    )
-                    g.payload = payload
-                except jsonschema.ValidationError as e:
-                    raise error.MalformedPayloadException(e.message)
+            validate_payload(payload)
+            return payload
+
+        @wraps(f)
+        def wrapper(*args, **kw):
+            g.payload = load_payload()
             return f(*args, **kw)
 
         return wrapper
@@ -51,6 +122,38 @@ def validate(schema):
     return decorator
 
 
+def _build_body(payload, error_code, error_message, success):
+    body = {}
+
+    if error_code is not None:
+        error = {"errorCode": error_code}
+        if error_message is not None:
+            error["errorMessage"] = error_message
+        body["error"] = error
+
+    if payload is not None:
+        body["payload"] = payload
+    elif success is not None:
+        body["payload"] = {}
+    if success is not None:
+        body["payload"]["success"] = success
+    return body
+
+
+def encode_body(payload=None, error_code=None, error_message=None, success=None):
+    """Returns the encoded body of an API response"""
+    return (
+        serializer.dumps(_build_body(payload, error_code, error_message, success))
+        + b"\n"
+    )
+
+
+# Bodies of acknowledgements by success flag, encoded once. Errors with fixed
+# messages are encoded once by error.encode_fixed_bodies().
+_acknowledgements = {flag: encode_body(success=flag) for flag in (True, False)}
+
+
+@metrics.timed("response")
 def response(
     payload=None,
     status_code=200,
@@ -58,33 +161,57 @@ def response(
     error_message=None,
     success=None,
     empty=False,
+    body=None,
 ):
-    """Method to build the default API response"""
+    """Method to build the default API response
+
+    body may be given instead of the other fields if it is already encoded.
+    """
     if empty:
-        response = ""
-        status_code = 204
-        r = Response()
-    else:
-        response = {}
+        return Response(status=204)
 
-        if error_code is not None:
-            error = {"errorCode": error_code}
-            if error_message is not None:
-                error["errorMessage"] = error_message
-            response["error"] = error
+    if body is None:
+        if payload is None and error_code is None and success in _acknowledgements:
+            body = _acknowledgements[success]
+        else:
+            body = encode_body(payload, error_code, error_message, success)
+    r = Response(body, status=status_code, mimetype="application/json")
 
-        if payload is not None:
-            response["payload"] = payload
-        elif success is not None:
-            response["payload"] = {}
-        if success is not None:
-            response["payload"]["success"] = success
+    if error_code is not None:
+        r.headers.add("X-ErrorCode", error_code)
 
-        r = jsonify(**response)
+    return r
 
-        if error_code is not None:
-            r.headers.add("X-ErrorCode", error_code)
 
+def encoded_response(payload, status_code=200):
+    """Method to build an API response around an already JSON encoded payload"""
+    r = Response(b'{"payload":' + payload + b"}\n", mimetype="application/json")
     r.status_code = status_code
-
     return r
+
+
+def stream_response(items, encode, **fields):
+    """Method to build an API response with a streamed list payload
+
+    Every item is encoded on its own with encode(), so the complete payload
+    never has to be held in memory. Additional top level fields are sent
+    after the payload and may be callables, which are evaluated once all
+    items have been sent.
+    """
+
+    def generate():
+        yield '{"payload":['
+        first = True
+        for item in items:
+            if not first:
+                yield ","
+            first = False
+            yield encode(item)
+        yield "]"
+        for key, value in fields.items():
+            if callable(value):
+                value = value()
+            yield "," + json.dumps(key) + ":" + json.dumps(value)
+        yield "}"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")